@@ -0,0 +1,34 @@
+# Compares the indented JSON metadata format against png_data_codec: bytes per row, and decode time
+# per row, which is most of what opening a large collection costs.
+# Usage: python -m benchmarks.bench_codec <image_directory> [row_count]
+import json
+import sys
+import time
+from dataclasses import asdict
+
+import lib.png_data_codec as codec
+from benchmarks.bench_ingest import find_pngs
+from lib.png_data import PngData
+from lib.png_parser import PngParser
+
+def report(name, blobs, decode):
+    total_bytes = sum(len(blob) for blob in blobs.values())
+    start = time.perf_counter()
+    for image_path, blob in blobs.items():
+        decode(blob, image_path)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<8} {total_bytes / len(blobs):.0f} bytes/row, decoded {len(blobs)} rows in {elapsed:.3f}s -> {len(blobs) / elapsed:.0f} rows/sec")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m benchmarks.bench_codec <image_directory> [row_count]")
+        sys.exit(1)
+    row_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    png_parser = PngParser()
+    png_datas = [png_parser.parse(image_path) for image_path in find_pngs(sys.argv[1], 64)]
+    paths = [f"{png_datas[i % len(png_datas)].image_path}.{i}" for i in range(row_count)]
+
+    json_blobs = {path: json.dumps(asdict(png_datas[i % len(png_datas)]), indent=4) for i, path in enumerate(paths)}
+    codec_blobs = {path: codec.encode(png_datas[i % len(png_datas)]) for i, path in enumerate(paths)}
+    report("json", json_blobs, lambda blob, image_path: PngData(**json.loads(blob)))
+    report("codec", codec_blobs, codec.decode)
@@ -0,0 +1,68 @@
+# Measures database size and collection-open time before and after migrating a legacy database
+# (thumbnails inlined as base64 in indented JSON metadata) to the current schema.
+# Usage: python -m benchmarks.bench_database <image_directory> [row_count]
+import base64
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import closing
+from dataclasses import asdict
+
+import lib.image_helpers as imagez
+from benchmarks.bench_ingest import find_pngs
+import lib.png_data_codec as codec
+from lib.database import Database
+from lib.png_parser import PngParser
+
+def make_legacy_database(database_path, png_datas, thumbnails, row_count):
+    # The original format: one JSON blob per image, with the thumbnail inlined as base64
+    with closing(sqlite3.connect(database_path)) as connection:
+        connection.execute("CREATE TABLE images (image_path TEXT PRIMARY KEY, metadata BLOB)")
+        for i in range(row_count):
+            png_data = png_datas[i % len(png_datas)]
+            json_metadata = asdict(png_data)
+            json_metadata["image_path"] = f"{png_data.image_path}.{i}"
+            json_metadata["thumbnail_base64"] = base64.b64encode(thumbnails[i % len(thumbnails)]).decode('utf-8')
+            connection.execute("INSERT INTO images VALUES (?, ?)", (json_metadata["image_path"], json.dumps(json_metadata, indent=4)))
+        connection.commit()
+
+def open_collection(database_path):
+    # What opening a collection costs: decode the metadata of every row
+    with closing(sqlite3.connect(database_path)) as connection:
+        return len([codec.decode(_strip_thumbnail(metadata), image_path)
+                    for image_path, metadata in connection.execute("SELECT image_path, metadata FROM images")])
+
+def _strip_thumbnail(metadata):
+    if codec.is_encoded(metadata):
+        return metadata
+    json_metadata = json.loads(metadata)
+    json_metadata.pop("thumbnail_base64", None)
+    return json.dumps(json_metadata)
+
+def report(name, database_path):
+    start = time.perf_counter()
+    count = open_collection(database_path)
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(database_path) / (1024 * 1024)
+    print(f"{name:<10} {size:.1f} MB on disk, opened {count} rows in {elapsed:.2f}s")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m benchmarks.bench_database <image_directory> [row_count]")
+        sys.exit(1)
+    row_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    image_paths = find_pngs(sys.argv[1], 64)
+    png_parser = PngParser()
+    png_datas = [png_parser.parse(image_path) for image_path in image_paths]
+    thumbnails = [imagez.load_thumbnails(image_path)[256] for image_path in image_paths] # The legacy size
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        make_legacy_database(os.path.join(temp_dir, "data.sqlite3"), png_datas, thumbnails, row_count)
+        report("legacy", os.path.join(temp_dir, "data.sqlite3"))
+        start = time.perf_counter()
+        Database(temp_dir, "data.sqlite3").close()
+        print(f"Migration took {time.perf_counter() - start:.2f}s")
+        report("migrated", os.path.join(temp_dir, "data.sqlite3"))
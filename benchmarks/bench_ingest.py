@@ -0,0 +1,46 @@
+# Compares first-time ingest throughput of the thread pool path against the process pool path.
+# Usage: python -m benchmarks.bench_ingest <image_directory> [limit]
+import concurrent.futures
+import os
+import sys
+import time
+
+from lib.ingest import ProcessIngestEngine
+from lib.png_parser import PngParser
+
+def find_pngs(dir_path, limit):
+    image_paths = []
+    for root, dirs, files in os.walk(dir_path):
+        for file in files:
+            if file.lower().endswith(".png") and not file.startswith("."):
+                image_paths.append(os.path.join(root, file))
+    image_paths.sort()
+    return image_paths[:limit] if limit else image_paths
+
+def bench_threads(image_paths):
+    png_parser = PngParser()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        return len(list(executor.map(png_parser.parse, image_paths)))
+
+def bench_processes(image_paths):
+    ingest_engine = ProcessIngestEngine()
+    try:
+        return sum(len(chunk) for chunk in ingest_engine.parse(image_paths))
+    finally:
+        ingest_engine.shutdown()
+
+def report(name, func, image_paths):
+    start = time.perf_counter()
+    count = func(image_paths)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<10} {count} images in {elapsed:.2f}s -> {count / elapsed:.1f} images/sec")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m benchmarks.bench_ingest <image_directory> [limit]")
+        sys.exit(1)
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    image_paths = find_pngs(sys.argv[1], limit)
+    print(f"Benchmarking ingest of {len(image_paths)} images ({os.cpu_count()} cpus)")
+    report("threads", bench_threads, image_paths)
+    report("processes", bench_processes, image_paths)
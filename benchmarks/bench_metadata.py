@@ -0,0 +1,50 @@
+# Compares reading prompt metadata through a full PIL decode against the chunk-level reader.
+# Usage: python -m benchmarks.bench_metadata <image_directory> [limit]
+import io
+import os
+import sys
+import time
+
+from PIL import Image
+
+import lib.png_chunks as pngchunks
+from benchmarks.bench_ingest import find_pngs
+
+bytes_read = 0
+
+class CountingFile(io.FileIO):
+    def readinto(self, buffer):
+        global bytes_read
+        count = super().readinto(buffer)
+        bytes_read += count or 0
+        return count
+
+def counting_open(path, mode="rb"):
+    return io.BufferedReader(CountingFile(path, mode))
+
+def read_with_pil(image_path):
+    global bytes_read
+    im = Image.open(image_path)
+    im.load()
+    bytes_read += os.path.getsize(image_path)
+    return im.info
+
+def report(name, func, image_paths):
+    global bytes_read
+    bytes_read = 0
+    start = time.perf_counter()
+    for image_path in image_paths:
+        func(image_path)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<8} {1000 * elapsed / len(image_paths):.2f} ms/image, {bytes_read / len(image_paths) / 1024:.1f} KB read/image")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m benchmarks.bench_metadata <image_directory> [limit]")
+        sys.exit(1)
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    image_paths = find_pngs(sys.argv[1], limit)
+    print(f"Benchmarking metadata reads of {len(image_paths)} images")
+    report("pil", read_with_pil, image_paths)
+    pngchunks.open = counting_open # Route the chunk reader through the byte counter
+    report("chunks", pngchunks.read_text_chunks, image_paths)
@@ -0,0 +1,106 @@
+# Times reopening a synthetic collection from its snapshot against the way it opens without one: decoding
+# every cached row and indexing it into the tag cache and the gallery's sort orders. Rows are decoded from
+# codec blobs held in memory, so the second number leaves out SQLite's own read time.
+# Usage: python -m benchmarks.bench_snapshot [image_count] [tag_count] [tags_per_image]
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_tag_cache import make_collection
+from controls.image_gallery import SNAPSHOT_ORDERS, SORT_KEYS, ImageGallery
+from lib.collection_snapshot import CollectionSnapshot, paused_gc, write_snapshot
+from lib.image_cache import ImageCache, ImageSummary
+from lib.png_data import PngData
+import lib.png_data_codec as codec
+from lib.tag_cache import TagCache
+
+DIRECTORY = "/images"
+CHANGE_COUNT = 1
+
+class Config:
+    def get_config(self, key):
+        return {"images_per_page": 100, "infinite_scroll": False}[key]
+
+def make_png_datas(images):
+    rng = random.Random(0)
+    checkpoints = [f"model {i}" for i in range(20)]
+    return [
+        PngData(
+            image_path=path,
+            favorite=rng.random() < 0.01,
+            checkpoint=rng.choice(checkpoints),
+            loras=[],
+            positive_prompt=", ".join(tags),
+            negative_prompt="lowres, bad anatomy",
+            tags=list(tags),
+            timestamp=1700000000 + rng.random() * 1e7,
+        )
+        for path, tags in images
+    ]
+
+def open_from_rows(rows, file_sizes):
+    tag_cache = TagCache()
+    image_cache = ImageCache()
+    gallery = ImageGallery(None, Config(), None, None, None)
+    for image_path, metadata in rows:
+        png_data = codec.decode(metadata, image_path)
+        image_cache.set(image_path, png_data)
+        tag_cache.add_all(png_data.tags, image_path)
+        gallery.add_image(png_data, file_sizes[image_path])
+    gallery.images # Merges the added records into every order
+    return tag_cache, gallery
+
+def open_from_snapshot(snapshot_path):
+    # Like load_images_from_directory
+    snapshot = CollectionSnapshot.open(snapshot_path, DIRECTORY, CHANGE_COUNT)
+    with paused_gc():
+        tag_cache = TagCache()
+        tag_cache.restore(snapshot.image_paths, snapshot.tags)
+        image_cache = ImageCache()
+        image_cache.restore(snapshot)
+        snapshot.get_fingerprints()
+        gallery = ImageGallery(None, Config(), None, None, None)
+        gallery.restore(snapshot)
+        gallery.images
+    return tag_cache, gallery
+
+if __name__ == "__main__":
+    image_count = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    tag_count = int(sys.argv[2]) if len(sys.argv) > 2 else 30000
+    tags_per_image = int(sys.argv[3]) if len(sys.argv) > 3 else 25
+    print(f"{image_count} images, {tag_count} tags, {tags_per_image} tags per image")
+    _, images = make_collection(image_count, tag_count, tags_per_image)
+    png_datas = make_png_datas(images)
+    file_sizes = {png_data.image_path: 1000000 + i for i, png_data in enumerate(png_datas)}
+    rows = [(png_data.image_path, codec.encode(png_data)) for png_data in png_datas]
+
+    start = time.perf_counter()
+    tag_cache, gallery = open_from_rows(rows, file_sizes)
+    rows_elapsed = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        snapshot_path = os.path.join(temp_dir, "collection.snapshot")
+        start = time.perf_counter()
+        image_paths, tags = tag_cache.export()
+        summaries = [
+            ImageSummary(png_data.image_path, png_data.timestamp, png_data.favorite, png_data.checkpoint, png_data.tag_count, file_sizes[png_data.image_path], 0.0)
+            for png_data in png_datas
+        ]
+        write_snapshot(snapshot_path, DIRECTORY, CHANGE_COUNT, summaries, tags, {name: SORT_KEYS[name] for name in SNAPSHOT_ORDERS})
+        write_elapsed = time.perf_counter() - start
+        snapshot_size = os.path.getsize(snapshot_path)
+
+        start = time.perf_counter()
+        restored_tag_cache, restored_gallery = open_from_snapshot(snapshot_path)
+        snapshot_elapsed = time.perf_counter() - start
+
+    for name in SNAPSHOT_ORDERS:
+        assert [record.image_path for record in restored_gallery.sort_indexes[name].records] == [record.image_path for record in gallery.sort_indexes[name].records], f"{name} order differs"
+    tag = tag_cache.get_all()[len(tags) // 2].name
+    assert restored_tag_cache.get_paths(tag) == tag_cache.get_paths(tag), f"{tag} postings differ"
+
+    print(f"Decoding and indexing rows: {rows_elapsed:.2f}s")
+    print(f"Writing the snapshot:       {write_elapsed:.2f}s, {snapshot_size / 1024 / 1024:.1f} MB")
+    print(f"Opening the snapshot:       {snapshot_elapsed:.2f}s ({rows_elapsed / snapshot_elapsed:.1f}x faster)")
@@ -0,0 +1,104 @@
+# Compares the old TagCache (a list of paths per tag) against the id/bitmap TagCache on a synthetic
+# collection: build time, memory, and AND/OR/NOT query latency. Tag frequencies follow a Zipf curve,
+# like real prompts, where a few quality tags are on almost everything and most tags are rare.
+# Usage: python -m benchmarks.bench_tag_cache [image_count] [tag_count] [tags_per_image]
+import itertools
+import random
+import sys
+import time
+import tracemalloc
+
+from lib.tag_cache import TagCache
+
+class ListTagCache:
+    # The previous implementation, for comparison
+    def __init__(self):
+        self.tag_index = {}
+
+    def add(self, tag: str, filename: str):
+        tag = tag.strip().lower()
+        if tag not in self.tag_index:
+            self.tag_index[tag] = []
+        self.tag_index[tag].append(filename)
+
+def make_collection(image_count, tag_count, tags_per_image):
+    rng = random.Random(0)
+    tags = [f"tag {i}" for i in range(tag_count)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(tag_count)))
+    paths = [f"/images/{i:07d}.png" for i in range(image_count)]
+    return tags, [(path, set(rng.choices(tags, cum_weights=cum_weights, k=tags_per_image))) for path in paths]
+
+def fill(cache, images):
+    for path, tags in images:
+        if isinstance(cache, TagCache):
+            cache.add_all(tags, path)
+        else:
+            for tag in tags:
+                cache.add(tag, path)
+    return cache
+
+def build(cache_class, images):
+    # Timed and measured separately, since tracemalloc slows down every allocation
+    start = time.perf_counter()
+    fill(cache_class(), images)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    cache = fill(cache_class(), images)
+    memory = tracemalloc.get_traced_memory()[0] / (1024 * 1024)
+    tracemalloc.stop()
+    return cache, elapsed, memory
+
+def timed(func, repeat=5):
+    func() # Warm up, e.g. building bitmaps
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+if __name__ == "__main__":
+    image_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    tag_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    tags_per_image = int(sys.argv[3]) if len(sys.argv) > 3 else 12
+    tags, images = make_collection(image_count, tag_count, tags_per_image)
+    print(f"{image_count} images, {tag_count} tags, {tags_per_image} tags per image")
+
+    list_cache, elapsed, memory = build(ListTagCache, images)
+    print(f"{'list':<8} built in {elapsed:.1f}s, {memory:.0f} MB (path strings are shared, so this is just the index)")
+    tag_cache, elapsed, memory = build(TagCache, images)
+    print(f"{'bitmap':<8} built in {elapsed:.1f}s, {memory:.0f} MB, including the path <-> id maps")
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    [tag_cache.get_bitmap(tag) for tag in tags]
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0] / (1024 * 1024)
+    tracemalloc.stop()
+    cached = sum(1 for tag in tag_cache.get_all() if tag.bitmap is not None)
+    print(f"Building every tag's bitmap took {elapsed:.1f}s. {cached} common tags keep theirs, using {memory:.1f} MB.")
+
+    common, medium, rare = tags[0], tags[50], tags[len(tags) // 10]
+    queries = [
+        ("common AND medium", lambda files: [f for f in files[common] if f in files[medium]], # The old select_tag
+                              lambda a, b: a & b, common, medium),
+        ("medium AND rare", lambda files: [f for f in files[medium] if f in files[rare]],
+                            lambda a, b: a & b, medium, rare),
+        ("common OR medium", None, lambda a, b: a | b, common, medium),
+        ("common NOT medium", None, lambda a, b: a & ~b, common, medium),
+    ]
+    list_files = list_cache.tag_index
+    set_files = {tag: set(list_files[tag]) for tag in (common, medium, rare)}
+    for name, list_query, bitmap_query, a, b in queries:
+        results = []
+        if list_query is not None and len(list_files[b]) <= 2000:
+            results.append(f"list {timed(lambda: list_query(list_files), repeat=1)[0]:.1f} ms")
+        set_ops = {"AND": set.intersection, "OR": set.union, "NOT": set.difference}
+        set_op = set_ops[name.split()[1]]
+        results.append(f"set {timed(lambda: set_op(set_files[a], set_files[b]))[0]:.2f} ms")
+        bitmap_a, bitmap_b = tag_cache.get_bitmap(a), tag_cache.get_bitmap(b)
+        elapsed, bitmap = timed(lambda: bitmap_query(bitmap_a, bitmap_b))
+        results.append(f"bitmap {elapsed:.3f} ms")
+        results.append(f"bitmap + paths {timed(lambda: tag_cache.get_paths(bitmap_query(bitmap_a, bitmap_b)))[0]:.2f} ms")
+        print(f"{name:<20} {bitmap.bit_count()} matches: {', '.join(results)}")
+
+    elapsed, _ = timed(lambda: [tag.count() for tag in tag_cache.get_all()[:100]])
+    print(f"Top 100 tags with counts: {elapsed:.3f} ms")
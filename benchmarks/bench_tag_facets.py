@@ -0,0 +1,69 @@
+# Times per-tag counts within a filter selection on a synthetic collection: counting every selected
+# image's tag list against TagFacets, for a fresh count, for adding and removing filters one at a time, and
+# for a count right after a few images were added and removed, like the folder watcher does.
+# Removing a filter goes back to a selection that was already counted, so it's quick. A first count still
+# visits every image it can't take from a recent count. For the first filter here that's around 60000
+# images, which can take over 100 ms.
+# Usage: python -m benchmarks.bench_tag_facets [image_count] [tag_count] [tags_per_image]
+from collections import Counter
+import sys
+import time
+
+from benchmarks.bench_tag_cache import fill, make_collection
+from lib.tag_cache import TagCache
+from lib.tag_facets import TagFacets
+
+def build_facets(tags, all_bitmap):
+    facets = TagFacets(tags, all_bitmap)
+    facets.build()
+    return facets
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return (time.perf_counter() - start) * 1000, result
+
+if __name__ == "__main__":
+    image_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    tag_count = int(sys.argv[2]) if len(sys.argv) > 2 else 30000
+    tags_per_image = int(sys.argv[3]) if len(sys.argv) > 3 else 25
+    tags, images = make_collection(image_count, tag_count, tags_per_image)
+    print(f"{image_count} images, {tag_count} tags, {tags_per_image} tags per image")
+    tag_cache = fill(TagCache(), images)
+    tags_by_path = dict(images)
+
+    elapsed, facets = timed(lambda: build_facets(tag_cache.get_all(), tag_cache.get_all_bitmap()))
+    print(f"Facet index built in {elapsed:.0f} ms")
+
+    # Each step adds a filter, then they're removed again in reverse
+    filters = [tags[1], tags[5], tags[50]]
+    steps = [filters[:i] for i in range(1, len(filters) + 1)] + [filters[:i] for i in range(len(filters) - 1, 0, -1)]
+    for selected in steps:
+        selection = tag_cache.get_all_bitmap()
+        for tag in selected:
+            selection &= tag_cache.get_bitmap(tag)
+        paths = tag_cache.get_paths(selection)
+        scan_elapsed, expected = timed(lambda: Counter(tag for path in paths for tag in tags_by_path[path]))
+        elapsed, counts = timed(lambda: facets.count(selection))
+        assert counts == dict(expected)
+        print(f"{' AND '.join(selected):<30} {len(paths):>7} images, {len(counts):>6} tags: scan {scan_elapsed:.0f} ms, facets {elapsed:.1f} ms")
+
+    facets = build_facets(tag_cache.get_all(), tag_cache.get_all_bitmap()) # Starts over from every image
+    elapsed, _ = timed(lambda: facets.count(tag_cache.get_bitmap(tags[5])))
+    print(f"Fresh count for {tags[5]}: {elapsed:.1f} ms")
+
+    # Like a folder watcher batch: the facets are updated in place instead of being rebuilt
+    facets = tag_cache.get_facets()
+    facets.build()
+    facets.count(tag_cache.get_bitmap(tags[5]))
+    for i, (path, image_tags) in enumerate(images[:5]):
+        for tag in image_tags:
+            tag_cache.remove(tag, path)
+        tag_cache.remove_image(path)
+        tag_cache.add_all(image_tags, f"{path}.new")
+        tags_by_path[f"{path}.new"] = image_tags
+    selection = tag_cache.get_bitmap(tags[5])
+    elapsed, counts = timed(lambda: facets.count(selection))
+    assert tag_cache.get_facets() is facets
+    assert counts == dict(Counter(tag for path in tag_cache.get_paths(selection) for tag in tags_by_path[path]))
+    print(f"Count for {tags[5]} after 5 images were replaced: {elapsed:.1f} ms")
@@ -0,0 +1,46 @@
+# Compares the old tag filter (a substring test against every tag) with TagSearchIndex on a synthetic
+# set of distinct tags, most of them long natural-language phrases, like prompts produce.
+# Usage: python -m benchmarks.bench_tag_search [tag_count] [limit]
+import random
+import sys
+import time
+from array import array
+
+from lib.tag_data import TagData
+from lib.tag_search import TAG_KIND_LORA, TAG_KIND_MODEL, TAG_KIND_TAG, TagSearchIndex
+
+def make_tags(tag_count):
+    rng = random.Random(0)
+    syllables = ["ka", "ri", "mo", "to", "na", "shi", "lu", "ve", "ar", "en", "ol", "ix", "be", "da", "go"]
+    words = list(set("".join(rng.choices(syllables, k=rng.randint(1, 4))) for _ in range(5000)))
+    names = set()
+    while len(names) < tag_count:
+        name = " ".join(rng.choices(words, k=rng.choice([1, 1, 2, 3, 6, 12])))
+        names.add(rng.choice(["", "", "", "", "", "", "", "", "model:", "lora:"]) + name)
+    # Zipf-ish counts, most used first like TagCache.get_all()
+    return [TagData(name, array("I", range(tag_count // (rank + 1) + 1))) for rank, name in enumerate(names)]
+
+def timed(func, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+if __name__ == "__main__":
+    tag_count = int(sys.argv[1]) if len(sys.argv) > 1 else 150000
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    tags = make_tags(tag_count)
+    start = time.perf_counter()
+    search_index = TagSearchIndex(tags)
+    print(f"{tag_count} tags, index built in {time.perf_counter() - start:.2f}s")
+
+    def scan(text):
+        return [tag for tag in tags if text in tag.name]
+
+    def search(text):
+        return [tag for kind in (TAG_KIND_MODEL, TAG_KIND_LORA, TAG_KIND_TAG) for tag in search_index.search(text, limit, kind)]
+
+    for text in ["k", "ka", "kar", "mosh", "lu ve", "ixbeda", "zzz"]:
+        scan_ms, scan_results = timed(lambda: scan(text))
+        search_ms, search_results = timed(lambda: search(text))
+        print(f"{text!r:<10} scan {scan_ms:6.2f} ms ({len(scan_results)} matches), index {search_ms:6.3f} ms (top {len(search_results)})")
@@ -0,0 +1,79 @@
+# Times thumbnail making for the eager tiers: the old pipeline that converts the full-sized image to RGB
+# before shrinking it, against make_thumbnails as JPEG and as WebP. Reports ms per image and bytes per
+# thumbnail. Without an image directory it makes synthetic images at typical SD output sizes.
+# Usage: python -m benchmarks.bench_thumbnails [image_directory] [limit]
+from io import BytesIO
+import os
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from benchmarks.bench_ingest import find_pngs
+import lib.image_helpers as imagez
+
+SD_SIZES = [(1024, 1024), (832, 1216), (1216, 832), (1536, 1536), (2048, 2048)]
+
+def make_images(directory, count):
+    image_paths = []
+    for i in range(count):
+        size = SD_SIZES[i % len(SD_SIZES)]
+        # Smooth gradients with some grain compress about like real renders; pure noise would not
+        gradient = Image.radial_gradient("L").resize(size)
+        noise = Image.effect_noise(size, 12 + i)
+        image = Image.merge("RGB", (gradient, Image.blend(gradient, noise, 0.3), Image.linear_gradient("L").resize(size)))
+        if i % 3 == 0:
+            image = image.convert("RGBA") # Some UIs save with an alpha channel
+        image_path = os.path.join(directory, f"{i:05}.png")
+        image.save(image_path, compress_level=1)
+        image_paths.append(image_path)
+    return image_paths
+
+def convert_then_shrink(image, tiers, format):
+    # The pipeline before this benchmark: a full-sized RGB copy first, then each tier
+    thumbnails = {}
+    image = image.convert('RGB')
+    for tier in sorted(tiers, reverse=True):
+        image.thumbnail((tier, tier))
+        membuf = BytesIO()
+        image.save(membuf, format=format, quality=85)
+        thumbnails[tier] = membuf.getvalue()
+    return thumbnails
+
+OPTIONS = [
+    ("convert, then shrink (JPEG)", convert_then_shrink, imagez.THUMBNAIL_FORMAT_JPEG),
+    ("make_thumbnails (JPEG)", imagez.make_thumbnails, imagez.THUMBNAIL_FORMAT_JPEG),
+    ("make_thumbnails (WebP)", imagez.make_thumbnails, imagez.THUMBNAIL_FORMAT_WEBP),
+]
+
+def bench(image_paths, func_make_thumbnails, format):
+    decode_elapsed = 0
+    elapsed = 0
+    sizes = {tier: 0 for tier in imagez.EAGER_THUMBNAIL_TIERS}
+    for image_path in image_paths:
+        with Image.open(image_path) as image:
+            # PNGs decode in full either way, so that's timed apart from the pipeline
+            start = time.perf_counter()
+            image.load()
+            decode_elapsed += time.perf_counter() - start
+            start = time.perf_counter()
+            thumbnails = func_make_thumbnails(image, imagez.EAGER_THUMBNAIL_TIERS, format)
+            elapsed += time.perf_counter() - start
+        for tier, thumbnail in thumbnails.items():
+            sizes[tier] += len(thumbnail)
+    count = len(image_paths)
+    return decode_elapsed * 1000 / count, elapsed * 1000 / count, {tier: size // count for tier, size in sizes.items()}
+
+if __name__ == "__main__":
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if len(sys.argv) > 1:
+            image_paths = find_pngs(sys.argv[1], limit)
+        else:
+            image_paths = make_images(temp_dir, limit)
+        print(f"{len(image_paths)} images, tiers {', '.join(str(tier) for tier in imagez.EAGER_THUMBNAIL_TIERS)}")
+        for name, func_make_thumbnails, format in OPTIONS:
+            decode_ms, ms, sizes = bench(image_paths, func_make_thumbnails, format)
+            size_text = ", ".join(f"{tier}px {size / 1024:.1f} KB" for tier, size in sorted(sizes.items()))
+            print(f"{name:<28} {ms:6.1f} ms/image (+{decode_ms:.1f} ms decoding)  {size_text}")
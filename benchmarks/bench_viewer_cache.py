@@ -0,0 +1,64 @@
+# Times stepping through images the way the image viewer's arrow keys do, once the viewer cache has
+# prefetched the neighbours. tests/test_viewer_cache.py checks that those steps read nothing from disk.
+# Without an image directory it makes synthetic 2048x2048 PNGs in a temporary folder.
+# Usage: python -m benchmarks.bench_viewer_cache [image_directory] [count]
+import os
+import random
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+import lib.image_helpers as imagez
+from lib.viewer_cache import ViewerCache
+
+VIEWER_SIZE = (1536, 1024)
+PREFETCH_STEPS = (1, -1, 2, -2) # As the viewer asks for them
+
+def make_images(directory, count):
+    image_paths = []
+    for i in range(count):
+        image = Image.effect_noise((2048, 2048), 40 + i).convert("RGB")
+        image_path = os.path.join(directory, f"{i:05}.png")
+        image.save(image_path, compress_level=1)
+        image_paths.append(image_path)
+    return image_paths
+
+def show(viewer_cache, image_paths, index):
+    # Like create_image_popup: a lookup, a load on a miss, then the neighbours are prefetched
+    start = time.perf_counter()
+    image_path = image_paths[index]
+    if viewer_cache.lookup(image_path) is None:
+        viewer_cache.load(image_path)
+    elapsed = (time.perf_counter() - start) * 1000
+    viewer_cache.prefetch([image_paths[(index + step) % len(image_paths)] for step in PREFETCH_STEPS])
+    return elapsed
+
+if __name__ == "__main__":
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if len(sys.argv) > 1:
+            image_paths = sorted(os.path.join(sys.argv[1], name) for name in os.listdir(sys.argv[1]) if name.lower().endswith(".png"))[:count]
+        else:
+            image_paths = make_images(temp_dir, count)
+        print(f"{len(image_paths)} images, shown at up to {VIEWER_SIZE[0]}x{VIEWER_SIZE[1]}")
+
+        viewer_cache = ViewerCache(lambda image_path: imagez.load_display_image(image_path, VIEWER_SIZE), 256 * 1024 * 1024)
+        elapsed = show(viewer_cache, image_paths, 0)
+        print(f"First image, from disk: {elapsed:.0f} ms")
+        viewer_cache.wait_for_prefetch()
+
+        # Random steps of one or two either way stay within what was prefetched, as long as the viewer
+        # isn't stepped faster than prefetching finishes
+        index = 0
+        timings = []
+        for _ in range(len(image_paths) * 4):
+            index = (index + random.choice(PREFETCH_STEPS)) % len(image_paths)
+            timings.append(show(viewer_cache, image_paths, index))
+            viewer_cache.wait_for_prefetch()
+        viewer_cache.stop()
+
+        stats = viewer_cache.stats()
+        print(f"{len(timings)} steps: {sum(timings) / len(timings):.2f} ms on average, {max(timings):.2f} ms at most")
+        print(f"{stats['hits']} hits, {stats['misses']} misses, {stats['reads']} reads, {stats['images']} images in {stats['bytes'] / 1024 / 1024:.1f} MB")
@@ -0,0 +1,58 @@
+# Measures rows/sec written during a cold ingest: one connection and commit per row (the old Database)
+# against the queued, batched writer. Both are fed from 8 threads, like load_images_from_directory.
+# Usage: python -m benchmarks.bench_writes [row_count]
+import concurrent.futures
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import closing
+from dataclasses import asdict
+
+from lib.database import Database, DiskCacheEntry
+from lib.png_data import PngData
+
+def make_png_data(i):
+    return PngData(
+        image_path=f"/images/{i:07d}.png",
+        checkpoint="model",
+        loras=["lora_a", "lora_b"],
+        positive_prompt="masterpiece, best quality, 1girl, solo, long hair, blue sky, city, night",
+        negative_prompt="bad hands",
+        tags=["masterpiece", "best quality", "1girl", "solo", "long hair", "blue sky", "city", "night"],
+        timestamp=float(i),
+    )
+
+def bench_connection_per_row(temp_dir, png_datas):
+    database_path = os.path.join(temp_dir, "per_row.sqlite3")
+    with closing(sqlite3.connect(database_path)) as connection:
+        connection.execute("CREATE TABLE images (image_path TEXT PRIMARY KEY, metadata BLOB)")
+    def upsert(png_data):
+        with closing(sqlite3.connect(database_path, timeout=60)) as connection:
+            connection.execute("REPLACE INTO images VALUES (?, ?)", (png_data.image_path, json.dumps(asdict(png_data), indent=4)))
+            connection.commit()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(upsert, png_datas))
+
+def bench_batched_writer(temp_dir, png_datas):
+    database = Database(temp_dir, "batched.sqlite3")
+    def upsert(png_data):
+        database.upsert(DiskCacheEntry(image_path=png_data.image_path, png_data=png_data, file_size=1, file_mtime=1.0))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(upsert, png_datas))
+    database.close()
+
+def report(name, func, temp_dir, png_datas):
+    start = time.perf_counter()
+    func(temp_dir, png_datas)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<20} {len(png_datas)} rows in {elapsed:.2f}s -> {len(png_datas) / elapsed:.0f} rows/sec")
+
+if __name__ == "__main__":
+    row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    png_datas = [make_png_data(i) for i in range(row_count)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        report("connection per row", bench_connection_per_row, temp_dir, png_datas)
+        report("batched writer", bench_batched_writer, temp_dir, png_datas)
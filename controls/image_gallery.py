@@ -1,28 +1,88 @@
+from dataclasses import dataclass
 from functools import partial
+from operator import attrgetter
 import random
 import threading
 import math
 import flet as ft
 
 from lib.configurator import Configurations
+import lib.image_helpers as imagez
+from lib.sort_index import SortIndex
 
 SORT_DATE_DESC = "Date: Newest First"
 SORT_DATE_ASC = "Date: Oldest First"
+SORT_CHECKPOINT = "Checkpoint"
+SORT_FILE_SIZE = "File Size: Largest First"
+SORT_TAG_COUNT = "Tags: Most First"
 SORT_SHUFFLE = "Shuffle"
 
 SORT_DEFAULT = SORT_DATE_DESC
 
+# Every order is kept up to date as images come and go. The path makes each key unique.
+SORT_KEYS = {
+    "date": attrgetter("timestamp", "image_path"),
+    "checkpoint": attrgetter("checkpoint", "timestamp", "image_path"),
+    "file_size": attrgetter("file_size", "image_path"),
+    "tag_count": attrgetter("tag_count", "image_path"),
+    "shuffle": attrgetter("shuffle_key", "image_path"),
+}
+# The orders a collection snapshot keeps, so restoring one doesn't sort. Shuffle gets a new seed anyway.
+SNAPSHOT_ORDERS = ("date", "checkpoint", "file_size", "tag_count")
+# Each sort is a view of one of the orders, maybe reversed, so changing the sort just swaps the view
+SORT_VIEWS = {
+    SORT_DATE_DESC: ("date", True),
+    SORT_DATE_ASC: ("date", False),
+    SORT_CHECKPOINT: ("checkpoint", False),
+    SORT_FILE_SIZE: ("file_size", True),
+    SORT_TAG_COUNT: ("tag_count", True),
+    SORT_SHUFFLE: ("shuffle", False),
+}
+
+# In infinite scroll mode, at most this many pages of controls are alive at once
+MAX_LIVE_PAGES = 3
+
+@dataclass(slots=True)
+class GalleryRecord:
+    # All the gallery keeps per image. Controls only exist for the records that are on screen.
+    image_path: str
+    timestamp: float
+    favorite: bool = False
+    checkpoint: str = ""
+    file_size: int = 0
+    tag_count: int = 0
+    shuffle_key: int = 0
+
 
 class ImageGallery:
-    def __init__(self, page: ft.Page, config: Configurations, filters_container, func_create_image_popup):
+    def __init__(self, page: ft.Page, config: Configurations, filters_container, func_create_image_popup, func_get_thumbnails, func_prioritize_thumbnails=None, lock=None):
         self.page = page
+        # Held by the gallery's own event handlers. Pass the lock that other threads hold while they add or
+        # remove images, so a handler never reads the records halfway through a change.
+        self.lock = lock or threading.RLock()
         self.page_id = 0## For Pagination
         self.func_create_image_popup = func_create_image_popup
+        self.func_get_thumbnails = func_get_thumbnails # (image_paths, tier) -> {image_path: (tier, thumbnail_base64)}
+        self.func_prioritize_thumbnails = func_prioritize_thumbnails
         self.selected_sort = SORT_DEFAULT
 
         self.images_per_page = int(config.get_config("images_per_page"))
+        self.infinite_scroll = bool(config.get_config("infinite_scroll"))
 
-        self.images = []
+        self.shuffle_seed = random.getrandbits(64)
+        self.__create_sort_indexes()
+        self.sort_view = self.sort_indexes["date"].view(reverse=True)
+        self.page_records = [] # Only the page on screen, while showing a page source
+        self.positions = None # Path -> index in self.images. Rebuilt on first use after they change.
+        self.containers_by_path = {} # Only the live controls
+        self.thumbnail_tiers = {} # Path -> tier of the thumbnail shown, for the live controls that have one
+        # The records that have controls: the current page, or the scrolled window in infinite scroll mode
+        self.window_start = 0
+        self.window_end = 0
+        # (total_count, func_get_page(offset, limit) -> [PngData]) while showing results that the caller
+        # pages, like a ranked database search. self.images is then only the page on screen.
+        self.page_source = None
+        self.__scroll_lock = threading.Lock()
 
         self.grid = ft.GridView(
             expand=True,
@@ -31,7 +91,11 @@ class ImageGallery:
             spacing=5,
             run_spacing=5,
             padding=ft.padding.only(right=15),
+            on_scroll_interval=100,
+            on_scroll=self.__on_scroll if self.infinite_scroll else None,
         )
+        # The smallest stored thumbnail size that fills a tile at the current zoom
+        self.thumbnail_tier = imagez.thumbnail_tier(self.grid.max_extent)
 
 
         optional = []
@@ -67,6 +131,10 @@ class ImageGallery:
                 ft.dropdown.Option(1)
             ]
         )
+        # Infinite scroll replaces the paging buttons
+        self.button_previous_page.visible = not self.infinite_scroll
+        self.page_dropdown.visible = not self.infinite_scroll
+        self.button_next_page.visible = not self.infinite_scroll
         return ft.Row([
             ft.Slider(min=64, max=512, value=256, divisions=7, label="{value}px", on_change=self.zoom_slider_update, expand=True),
             self.button_previous_page,
@@ -77,90 +145,341 @@ class ImageGallery:
                 width=200,
                 on_change=partial(self.change_sort),
                 value=SORT_DATE_DESC,
-                options=[
-                    ft.dropdown.Option(SORT_DATE_DESC),
-                    ft.dropdown.Option(SORT_DATE_ASC),
-                    ft.dropdown.Option(SORT_SHUFFLE),
-                ],
+                options=[ft.dropdown.Option(sort) for sort in SORT_VIEWS],
             )
         ])
     
 
+    def __create_sort_indexes(self):
+        self.sort_indexes = {name: SortIndex(key) for name, key in SORT_KEYS.items()}
+        self.records_by_path = {}
+        self.pending_records = [] # Added since the last read, so a batch of adds is merged in one pass
+
+    @property
+    def images(self):
+        """The GalleryRecords in display order, or just the page on screen while showing a page source."""
+        if self.page_source is not None:
+            return self.page_records
+        self.__add_pending_records()
+        return self.sort_view
+
     def clear(self):
         self.grid.controls.clear()
-        self.images = []
-
-    def add_image(self, png_data):
-        image_path=png_data.image_path
-        container = ft.Container(
-            on_click=partial(self.func_create_image_popup, image_path),
-            content=ft.Image(
-                src_base64=png_data.thumbnail_base64, 
-                fit=ft.ImageFit.COVER,
-                key=image_path,
-                border_radius=ft.border_radius.all(5)
-                ),
-            data=png_data
+        for sort_index in self.sort_indexes.values():
+            sort_index.records = []
+        self.records_by_path = {}
+        self.pending_records = []
+        self.page_records = []
+        self.positions = None
+        self.containers_by_path = {}
+        self.thumbnail_tiers = {}
+        self.window_start = 0
+        self.window_end = 0
+        self.page_source = None
+
+    def show_page_source(self, total_count, func_get_page):
+        """Shows total_count results in the order func_get_page returns them, fetching one page at a time."""
+        self.clear()
+        self.page_source = (total_count, func_get_page)
+        self.update_on_first_page()
+
+    def __create_thumbnail(self, image_path, thumbnail_base64):
+        if not thumbnail_base64:
+            # Placeholder until the ThumbnailQueue gets to this image
+            return ft.Container(
+                content=ft.Icon(ft.icons.IMAGE_OUTLINED, color=ft.colors.OUTLINE),
+                bgcolor=ft.colors.SURFACE_VARIANT,
+                alignment=ft.alignment.center,
+                border_radius=ft.border_radius.all(5),
+            )
+        return ft.Image(
+            src_base64=thumbnail_base64, 
+            fit=ft.ImageFit.COVER,
+            key=image_path,
+            border_radius=ft.border_radius.all(5)
+            )
+
+    def __create_record(self, png_data, file_size=0):
+        return GalleryRecord(
+            image_path=png_data.image_path,
+            timestamp=png_data.timestamp or 0,
+            favorite=png_data.favorite,
+            checkpoint=png_data.checkpoint or "",
+            file_size=file_size or 0,
+            tag_count=png_data.tag_count,
+            shuffle_key=hash((self.shuffle_seed, png_data.image_path)),
         )
-        # Is it ok to store all these Containers instead of just PNG data? 
-        self.images.insert(0, container)
-        # self.grid.controls.insert(0, container)
+
+    def add_image(self, png_data, file_size=0):
+        """Adds an image where every sort order puts it, once the gallery is next read or updated."""
+        if png_data.image_path in self.records_by_path:
+            self.__remove_records([png_data.image_path])
+        record = self.__create_record(png_data, file_size)
+        self.records_by_path[record.image_path] = record
+        self.pending_records.append(record)
+
+    def restore(self, snapshot, only_favorites=False):
+        """
+        Replaces the gallery's images with a CollectionSnapshot's, taken in the orders it saved instead of
+        sorted. With only_favorites, just its favorite images.
+        """
+        self.clear()
+        records = list(map(GalleryRecord, snapshot.image_paths, snapshot.timestamps, map(bool, snapshot.favorites),
+                           map(snapshot.checkpoints.__getitem__, snapshot.checkpoint_ids), snapshot.file_sizes, snapshot.tag_counts))
+        if only_favorites:
+            records = [record if record.favorite else None for record in records]
+        self.records_by_path = {record.image_path: record for record in records if record is not None}
+        for name, sort_index in self.sort_indexes.items():
+            if name == "shuffle":
+                continue # Rebuilt by __reshuffle whenever Shuffle is picked
+            order = snapshot.orders.get(name)
+            if order is None:
+                sort_index.records = sorted(self.records_by_path.values(), key=sort_index.key)
+            elif only_favorites:
+                sort_index.records = [records[i] for i in order if records[i] is not None]
+            else:
+                sort_index.records = list(map(records.__getitem__, order))
+        if self.selected_sort == SORT_SHUFFLE:
+            self.__reshuffle()
+
+    def __add_pending_records(self):
+        if not self.pending_records:
+            return
+        for sort_index in self.sort_indexes.values():
+            sort_index.add_many(self.pending_records)
+        self.pending_records = []
+        self.positions = None
+
+    def __remove_records(self, image_paths):
+        self.__add_pending_records()
+        records = [self.records_by_path.pop(image_path) for image_path in image_paths if image_path in self.records_by_path]
+        for sort_index in self.sort_indexes.values():
+            sort_index.remove_many(records)
+        # A re-added image gets a new control, since its file may have new pixels
+        for record in records:
+            self.containers_by_path.pop(record.image_path, None)
+            self.thumbnail_tiers.pop(record.image_path, None)
+        self.positions = None
+
+    def __reshuffle(self):
+        # A new seed gives a new order, which then stays put as images are added and removed
+        self.__add_pending_records()
+        self.shuffle_seed = random.getrandbits(64)
+        records = list(self.records_by_path.values())
+        for record in records:
+            record.shuffle_key = hash((self.shuffle_seed, record.image_path))
+        shuffle_index = self.sort_indexes["shuffle"]
+        shuffle_index.records = sorted(records, key=shuffle_index.key)
+        self.positions = None
+
+    def index_of(self, image_path):
+        """The position of an image in self.images, or None if the gallery doesn't show it."""
+        images = self.images
+        if self.positions is None:
+            self.positions = {record.image_path: i for i, record in enumerate(images)}
+        return self.positions.get(image_path)
+
+    def get_image_path(self, index):
+        """The image at a position in self.images, counting around from either end."""
+        images = self.images
+        if len(images) == 0:
+            return None
+        return images[index % len(images)].image_path
+
+    def get_neighbor(self, image_path, step):
+        """The image step places after image_path, wrapping around, or None if image_path isn't shown."""
+        index = self.index_of(image_path)
+        if index is None:
+            return None
+        return self.get_image_path(index + step)
+
+    def show_image(self, image_path) -> bool:
+        """Goes to the page with image_path on it. Returns False if the gallery doesn't show it."""
+        index = self.index_of(image_path)
+        if index is None:
+            return False
+        if self.page_source is None:
+            page_start = index - index % self.images_per_page
+            self.page_id = page_start // self.images_per_page
+            self.window_start = page_start
+            self.window_end = page_start + self.images_per_page
+            self.update()
+            self.grid.scroll_to(offset=0)
+        return True
+
+    def set_favorite(self, image_path, favorite):
+        record = self.records_by_path.get(image_path)
+        if record is not None:
+            record.favorite = favorite
+
+    def set_thumbnails(self, image_path, thumbnails_base64):
+        # Swaps in newly generated thumbnails, {tier: thumbnail_base64}, unless the one on screen is a closer fit already.
+        # Images that aren't on screen load theirs from the database when they're shown.
+        with self.lock:
+            container = self.containers_by_path.get(image_path)
+            if container is None:
+                return
+            tier = imagez.closest_tier(thumbnails_base64, self.thumbnail_tier)
+            shown_tier = self.thumbnail_tiers.get(image_path)
+            if shown_tier is not None and abs(shown_tier - self.thumbnail_tier) < abs(tier - self.thumbnail_tier):
+                return
+            self.__show_thumbnail(container, tier, thumbnails_base64[tier])
+        if container.page is not None:
+            container.update()
+
+    def __show_thumbnail(self, container, tier, thumbnail_base64):
+        container.content = self.__create_thumbnail(container.data.image_path, thumbnail_base64)
+        self.thumbnail_tiers[container.data.image_path] = tier
+
+    def __build_controls(self, records):
+        # Controls that are still on screen are reused as they are; only new ones are built and get thumbnails
+        containers_by_path = {}
+        new_containers = []
+        for record in records:
+            container = self.containers_by_path.get(record.image_path)
+            if container is None:
+                container = ft.Container(
+                    on_click=partial(self.func_create_image_popup, record.image_path),
+                    content=self.__create_thumbnail(record.image_path, None),
+                    data=record
+                )
+                new_containers.append(container)
+            container.data = record
+            containers_by_path[record.image_path] = container
+        self.containers_by_path = containers_by_path
+        self.thumbnail_tiers = {image_path: tier for image_path, tier in self.thumbnail_tiers.items() if image_path in containers_by_path}
+        self.__load_thumbnails(new_containers)
+        return [containers_by_path[record.image_path] for record in records]
+
+    def __load_thumbnails(self, containers):
+        missing_paths = [container.data.image_path for container in containers]
+        if not missing_paths:
+            return
+        thumbnails = self.func_get_thumbnails(missing_paths, self.thumbnail_tier)
+        for image_path, (tier, thumbnail_base64) in thumbnails.items():
+            self.__show_thumbnail(self.containers_by_path[image_path], tier, thumbnail_base64)
 
     def jump_to_page(self, e):
-        self.page_id = int(e.data) - 1
-        self.update()
+        with self.lock:
+            self.page_id = int(e.data) - 1
+            self.update()
 
     def page_count(self):
-        return math.ceil(len(self.images) / self.images_per_page)
+        total_count = self.page_source[0] if self.page_source is not None else len(self.images)
+        return math.ceil(total_count / self.images_per_page)
 
     def paginate_next(self, e):
         print("paginate_next")
-        self.page_id = (self.page_id + 1) % self.page_count()
-        self.update()
+        with self.lock:
+            self.page_id = (self.page_id + 1) % self.page_count()
+            self.update()
         self.grid.scroll_to(offset=0)
     def paginate_previous(self, e):
         print("paginate_previous")
-        self.page_id = (self.page_id - 1) % self.page_count()
-        self.update() 
+        with self.lock:
+            self.page_id = (self.page_id - 1) % self.page_count()
+            self.update()
         self.grid.scroll_to(offset=-1)
 
     def update_on_first_page(self):
         self.page_id = 0
+        self.window_start = 0
+        self.window_end = 0
         self.update()
 
     def update(self):
-        print(f"Showing page {self.page_id + 1} of {self.page_count()}")
-        start = self.images_per_page * self.page_id
-        end = start + self.images_per_page
-        self.grid.controls = self.images[start:end]
+        # Paged results always use the paging buttons, since only the current page is fetched
+        is_paged = not self.infinite_scroll or self.page_source is not None
+        self.button_previous_page.visible = is_paged
+        self.page_dropdown.visible = is_paged
+        self.button_next_page.visible = is_paged
+        if self.page_source is not None:
+            func_get_page = self.page_source[1]
+            self.page_records = [self.__create_record(png_data) for png_data in func_get_page(self.images_per_page * self.page_id, self.images_per_page)]
+            self.positions = None
+            self.window_start = 0
+            self.window_end = len(self.page_records)
+        elif self.infinite_scroll:
+            self.window_start = min(self.window_start, max(0, len(self.images) - self.images_per_page))
+            self.window_end = min(len(self.images), max(self.window_end, self.window_start + self.images_per_page))
+        else:
+            print(f"Showing page {self.page_id + 1} of {self.page_count()}")
+            self.window_start = self.images_per_page * self.page_id
+            self.window_end = self.window_start + self.images_per_page
+        images = self.images
+        self.grid.controls = self.__build_controls(images[self.window_start:self.window_end])
+        if self.func_prioritize_thumbnails:
+            current_page_paths = [record.image_path for record in images[self.window_start:self.window_end]]
+            next_page_paths = [record.image_path for record in images[self.window_end:self.window_end + self.images_per_page]]
+            self.func_prioritize_thumbnails(current_page_paths, next_page_paths)
         self.page_dropdown.options = [ft.dropdown.Option(x) for x in range(1, self.page_count() + 1)]
         self.page_dropdown.value = self.page_id + 1
+        self.button_previous_page.update()
         self.page_dropdown.update()
+        self.button_next_page.update()
         self.grid.update()
 
+    def __on_scroll(self, e: ft.OnScrollEvent):
+        # Grows the window of live controls by a page at whichever end is near, and drops a page from
+        # the other end past MAX_LIVE_PAGES. Grid rows are all the same height, so the scroll offset
+        # is corrected in proportion to the records that were added or removed in front.
+        if self.page_source is not None or not self.__scroll_lock.acquire(blocking=False):
+            return
+        try:
+            with self.lock:
+                content_height = e.max_scroll_extent + e.viewport_dimension
+                live_count = max(1, self.window_end - self.window_start)
+                shift = 0
+                if e.pixels >= e.max_scroll_extent - e.viewport_dimension and self.window_end < len(self.images):
+                    self.window_end = min(len(self.images), self.window_end + self.images_per_page)
+                    if self.window_end - self.window_start > MAX_LIVE_PAGES * self.images_per_page:
+                        self.window_start += self.images_per_page
+                        shift = -self.images_per_page
+                elif e.pixels <= e.viewport_dimension and self.window_start > 0:
+                    added = min(self.window_start, self.images_per_page)
+                    self.window_start -= added
+                    self.window_end = min(self.window_end, self.window_start + MAX_LIVE_PAGES * self.images_per_page)
+                    shift = added
+                else:
+                    return
+                self.update()
+                if shift:
+                    self.grid.scroll_to(offset=max(0, e.pixels + shift * content_height / live_count))
+        finally:
+            self.__scroll_lock.release()
+
     async def zoom_slider_update(self, e):
         self.grid.max_extent = e.control.value
+        tier = imagez.thumbnail_tier(e.control.value)
+        if tier != self.thumbnail_tier:
+            # Reloads the thumbnails on screen at the new size
+            with self.lock:
+                self.thumbnail_tier = tier
+                self.__load_thumbnails([container for image_path, container in self.containers_by_path.items() if self.thumbnail_tiers.get(image_path) != tier])
         self.page.update()
 
     def change_sort(self, e):
-        self.selected_sort = e.data
-        self.sort()
+        with self.lock:
+            self.selected_sort = e.data
+            if self.selected_sort == SORT_SHUFFLE:
+                self.__reshuffle()
+            self.sort()
     
     def sort(self):
-        if self.selected_sort == SORT_DATE_DESC:
-            self.images.sort(key=lambda x: x.data.timestamp, reverse=True)
-        elif self.selected_sort == SORT_DATE_ASC:
-            self.images.sort(key=lambda x: x.data.timestamp, reverse=False)
-        elif self.selected_sort == SORT_SHUFFLE:
-            random.shuffle(self.images)
-        else:
+        if self.page_source is not None:
+            return # Page sources keep their own order, e.g. ranked by the database
+        if self.selected_sort not in SORT_VIEWS:
             print(f"Invalid sort selection {self.selected_sort}")
+            return
+        name, reverse = SORT_VIEWS[self.selected_sort]
+        self.sort_view = self.sort_indexes[name].view(reverse)
+        self.positions = None
         self.update()
         self.page.update()
 
     def delete(self, image_path):
-        for i, entry in enumerate(self.images):
-            if entry.data.image_path == image_path:
-                del self.images[i]
-                break
+        self.delete_many([image_path])
+
+    def delete_many(self, image_paths):
+        self.__remove_records(image_paths)
         self.update()
\ No newline at end of file
@@ -0,0 +1,108 @@
+import math
+from typing import Dict, List
+
+import flet as ft
+
+from lib.tag_data import TagData
+from lib.tag_search import TAG_KIND_LORA, TAG_KIND_MODEL, TAG_KIND_TAG, tag_kind
+
+TAGS_PER_PAGE = 200
+
+
+class TagBrowser:
+    """
+    The Tags/Loras/Models tabs. Each tab keeps the full list of its tags, most used first, but only
+    the current page of them becomes buttons, so tens of thousands of tags don't turn into
+    tens of thousands of controls.
+    """
+    def __init__(self, func_select_tag, func_exclude_tag, tags_per_page=TAGS_PER_PAGE):
+        self.func_select_tag = func_select_tag
+        self.func_exclude_tag = func_exclude_tag
+        self.tags_per_page = tags_per_page
+
+        self.tags = {TAG_KIND_TAG: [], TAG_KIND_LORA: [], TAG_KIND_MODEL: []}
+        self.facet_counts = None
+        self.page_ids = {kind: 0 for kind in self.tags}
+        self.rows = {kind: self.__create_row() for kind in self.tags}
+        self.page_labels = {kind: ft.Text() for kind in self.tags}
+
+        self.view = ft.Tabs(
+            selected_index=0,
+            animation_duration=100,
+            expand=True,
+            tabs=[
+                ft.Tab(text="Tags", content=self.__create_tab(TAG_KIND_TAG)),
+                ft.Tab(text="Loras", content=self.__create_tab(TAG_KIND_LORA)),
+                ft.Tab(text="Models", content=self.__create_tab(TAG_KIND_MODEL)),
+            ],
+        )
+
+    def __create_row(self):
+        return ft.Row(
+            vertical_alignment=ft.CrossAxisAlignment.START,
+            controls=None,
+            wrap=True,
+            expand=True,
+            scroll=ft.ScrollMode.ALWAYS,
+            spacing=10,  # Spacing between buttons
+            run_spacing=10,  # Spacing between rows
+        )
+
+    def __create_tab(self, kind):
+        return ft.Column([
+            self.rows[kind],
+            ft.Row([
+                ft.IconButton(
+                    icon=ft.icons.ARROW_BACK_IOS_ROUNDED,
+                    tooltip="Previous Page",
+                    on_click=lambda e: self.paginate(kind, -1)
+                ),
+                self.page_labels[kind],
+                ft.IconButton(
+                    icon=ft.icons.ARROW_FORWARD_IOS_ROUNDED,
+                    tooltip="Next Page",
+                    on_click=lambda e: self.paginate(kind, 1)
+                ),
+            ], alignment=ft.MainAxisAlignment.CENTER),
+        ], expand=True)
+
+    def page_count(self, kind):
+        return max(1, math.ceil(len(self.tags[kind]) / self.tags_per_page))
+
+    def show_tags(self, tags: List[TagData], facet_counts: Dict[str, int] = None):
+        """
+        Replaces the tags in every tab and goes back to their first pages. tags should be most used first.
+        facet_counts is {tag: image count} within the current filters. If given, only those tags are shown,
+        most used within the filters first.
+        """
+        self.facet_counts = facet_counts
+        if facet_counts is not None:
+            tags = sorted((tag for tag in tags if tag.name in facet_counts), key=lambda tag: facet_counts[tag.name], reverse=True)
+        for kind in self.tags:
+            self.tags[kind] = []
+            self.page_ids[kind] = 0
+        for tag in tags:
+            self.tags[tag_kind(tag.name)].append(tag)
+        for kind in self.tags:
+            self.__render(kind)
+        self.view.update()
+
+    def paginate(self, kind, step):
+        self.page_ids[kind] = (self.page_ids[kind] + step) % self.page_count(kind)
+        self.__render(kind)
+        self.rows[kind].update()
+        self.page_labels[kind].update()
+        self.rows[kind].scroll_to(offset=0)
+
+    def __count_label(self, tag: TagData):
+        if self.facet_counts is None:
+            return tag.count()
+        return f"{self.facet_counts[tag.name]} of {tag.count()}"
+
+    def __render(self, kind):
+        start = self.page_ids[kind] * self.tags_per_page
+        self.rows[kind].controls = [
+            ft.ElevatedButton(f"{tag.name} ({self.__count_label(tag)})", on_click=self.func_select_tag, on_long_press=self.func_exclude_tag, data=tag)
+            for tag in self.tags[kind][start:start + self.tags_per_page]
+        ]
+        self.page_labels[kind].value = f"Page {self.page_ids[kind] + 1} of {self.page_count(kind)} ({len(self.tags[kind])} tags)"
@@ -0,0 +1,31 @@
+import itertools
+from typing import List
+
+# The positions of the set bits in every byte value, for turning sparse bitmaps back into ids
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte & (1 << bit)) for byte in range(256)]
+# Turns the ASCII digits of bin() into 0/1 bytes, for itertools.compress
+_BINARY_DIGITS = bytes.maketrans(b"01", b"\x00\x01")
+
+def to_bitmap(image_ids) -> int:
+    """Packs image ids into a Python int with bit i set for id i."""
+    if len(image_ids) == 0:
+        return 0
+    bits = bytearray((max(image_ids) >> 3) + 1)
+    for image_id in image_ids:
+        bits[image_id >> 3] |= 1 << (image_id & 7)
+    return int.from_bytes(bits, "little")
+
+def from_bitmap(bitmap: int) -> List[int]:
+    """Returns the ids set in a bitmap, in ascending order."""
+    if bitmap.bit_count() * 64 > bitmap.bit_length():
+        # Dense: let compress() pick out the set bits, without a Python loop
+        bits = bin(bitmap)[:1:-1].encode("ascii").translate(_BINARY_DIGITS)
+        return list(itertools.compress(range(len(bits)), bits))
+    # Sparse: only visit the non-zero bytes
+    image_ids = []
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) >> 3, "little")
+    for i, byte in enumerate(data):
+        if byte:
+            base = i << 3
+            image_ids.extend(base + bit for bit in _BYTE_BITS[byte])
+    return image_ids
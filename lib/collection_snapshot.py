@@ -0,0 +1,191 @@
+from array import array
+from contextlib import contextmanager
+from dataclasses import replace
+import gc
+from itertools import accumulate
+import math
+import mmap
+import os
+import struct
+from typing import Callable, Dict, List
+
+from lib.image_cache import ImageSummary
+from lib.tag_data import TagData
+
+MAGIC = b"SDGS"
+# Snapshots written with another version are ignored, and replaced when the collection is next saved
+FORMAT_VERSION = 1
+# Native byte order like the arrays, so a snapshot from a machine with the other one fails the version check
+HEADER = struct.Struct("=4sIQII") # magic, format version, database change count, section count, directory length
+SECTION = struct.Struct("=24sQQ") # name, offset, length
+ALIGNMENT = 8
+NO_FILE_SIZE = -1 # A missing file_mtime is NaN
+
+def snapshot_filename(database_filename) -> str:
+    """The snapshot that goes with a collection's database, in the same folder."""
+    return os.path.splitext(database_filename)[0] + ".snapshot"
+
+def _join(strings: List[str]) -> bytes:
+    joined = "\0".join(strings)
+    if joined.count("\0") != max(len(strings) - 1, 0):
+        raise ValueError("Snapshot strings can't contain NUL")
+    return joined.encode("utf-8", "surrogateescape")
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def write_snapshot(snapshot_path, directory, change_count, images: List[ImageSummary], tags: List[TagData], sort_keys: Dict[str, Callable]):
+    """
+    Saves images, and tags whose image_ids are positions in images, along with the order of images under
+    each of sort_keys ({name: key(ImageSummary)}). It's written to a temporary file and then moved into
+    place, so a reader only ever sees a whole snapshot.
+    """
+    # Sorted on what's stored, so an unknown file size sorts as NO_FILE_SIZE like it will once restored
+    images = [image if image.file_size is not None else replace(image, file_size=NO_FILE_SIZE) for image in images]
+    checkpoint_ids = {}
+    sections = {
+        "paths": _join([image.image_path for image in images]),
+        "timestamps": array("d", [image.timestamp for image in images]),
+        "favorites": array("B", [bool(image.favorite) for image in images]),
+        "checkpoint_ids": array("I", [checkpoint_ids.setdefault(image.checkpoint, len(checkpoint_ids)) for image in images]),
+        "checkpoints": _join(list(checkpoint_ids)),
+        "tag_counts": array("I", [image.tag_count for image in images]),
+        "file_sizes": array("q", [image.file_size for image in images]),
+        "file_mtimes": array("d", [math.nan if image.file_mtime is None else image.file_mtime for image in images]),
+        "tag_names": _join([tag_data.name for tag_data in tags]),
+        "tag_offsets": array("Q", accumulate((len(tag_data.image_ids) for tag_data in tags), initial=0)),
+        "postings": b"".join(tag_data.image_ids.tobytes() for tag_data in tags),
+    }
+    for name, key in sort_keys.items():
+        sections[f"order:{name}"] = array("I", sorted(range(len(images)), key=lambda i: key(images[i])))
+
+    directory_bytes = directory.encode("utf-8", "surrogateescape")
+    table = []
+    offset = HEADER.size + len(directory_bytes) + SECTION.size * len(sections)
+    for name, data in sections.items():
+        offset = _align(offset)
+        length = memoryview(data).nbytes
+        table.append((name, offset, length))
+        offset += length
+
+    temp_path = snapshot_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, change_count, len(sections), len(directory_bytes)))
+        f.write(directory_bytes)
+        for name, offset, length in table:
+            f.write(SECTION.pack(name.encode("ascii"), offset, length))
+        for (name, offset, length), data in zip(table, sections.values()):
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(data)
+    os.replace(temp_path, snapshot_path)
+
+@contextmanager
+def paused_gc():
+    """
+    For opening and restoring a snapshot. Every object that creates stays alive, but each allocation still
+    counts towards the cyclic collector's next pass, and the passes over an ever bigger heap would take
+    longer than the restore itself.
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+def delete_snapshot(snapshot_path):
+    try:
+        os.remove(snapshot_path)
+    except FileNotFoundError:
+        pass
+
+def read_change_count(snapshot_path) -> int:
+    """The database change count a snapshot was written at, from its header alone. None if it can't be read."""
+    try:
+        with open(snapshot_path, "rb") as f:
+            magic, version, change_count, _, _ = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC or version != FORMAT_VERSION:
+        return None
+    return change_count
+
+
+class CollectionSnapshot:
+    """
+    A collection's images, tags and sort orders as saved by write_snapshot. The file is memory-mapped and
+    each column is copied out of the map in one go, so opening one doesn't decode anything per image except
+    for splitting the paths. Images are in the order of the positions used by tags and orders.
+    """
+    def __init__(self, change_count, sections: Dict[str, memoryview]):
+        self.change_count = change_count
+        self.image_paths = _split(sections["paths"], len(sections["timestamps"]) // 8)
+        self.timestamps = _array("d", sections["timestamps"])
+        self.favorites = _array("B", sections["favorites"])
+        self.checkpoint_ids = _array("I", sections["checkpoint_ids"])
+        self.checkpoints = _split(sections["checkpoints"], max(self.checkpoint_ids, default=-1) + 1)
+        self.tag_counts = _array("I", sections["tag_counts"])
+        self.file_sizes = _array("q", sections["file_sizes"])
+        self.file_mtimes = _array("d", sections["file_mtimes"])
+
+        tag_offsets = _array("Q", sections["tag_offsets"])
+        postings = _array("I", sections["postings"])
+        tag_names = _split(sections["tag_names"], len(tag_offsets) - 1)
+        self.tags = [TagData(name, postings[start:end]) for name, start, end in zip(tag_names, tag_offsets, tag_offsets[1:])]
+        self.orders = {name[len("order:"):]: _array("I", data) for name, data in sections.items() if name.startswith("order:")}
+
+    @staticmethod
+    def open(snapshot_path, directory, change_count) -> "CollectionSnapshot":
+        """
+        Reads a snapshot, or returns None if there isn't one, it's damaged, or it doesn't match the directory
+        and the database's current change count.
+        """
+        sections = {}
+        try:
+            with open(snapshot_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                try:
+                    magic, version, snapshot_change_count, section_count, directory_length = HEADER.unpack_from(view)
+                    if magic != MAGIC or version != FORMAT_VERSION or snapshot_change_count != change_count:
+                        return None
+                    offset = HEADER.size + directory_length
+                    if str(view[HEADER.size:offset], "utf-8", "surrogateescape") != directory:
+                        return None
+                    for _ in range(section_count):
+                        name, start, length = SECTION.unpack_from(view, offset)
+                        offset += SECTION.size
+                        if start + length > len(view):
+                            raise ValueError("Section past the end of the file")
+                        sections[name.rstrip(b"\0").decode("ascii")] = view[start:start + length]
+                    with paused_gc():
+                        return CollectionSnapshot(change_count, sections)
+                finally:
+                    # The map can only close once nothing points into it
+                    for section in sections.values():
+                        section.release()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            print(f"ERROR: Ignoring unreadable snapshot {snapshot_path}: {e}")
+            return None
+
+    def get_fingerprints(self) -> Dict[str, tuple]:
+        """Returns {image_path: (file_size, file_mtime)}, with None for what wasn't known when it was saved."""
+        return {
+            image_path: (None if file_size == NO_FILE_SIZE else file_size, None if math.isnan(file_mtime) else file_mtime)
+            for image_path, file_size, file_mtime in zip(self.image_paths, self.file_sizes, self.file_mtimes)
+        }
+
+
+def _array(typecode, data: memoryview) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    return values
+
+def _split(data: memoryview, count) -> List[str]:
+    if count == 0:
+        return []
+    strings = str(data, "utf-8", "surrogateescape").split("\0")
+    if len(strings) != count:
+        raise ValueError(f"Expected {count} strings, found {len(strings)}")
+    return strings
@@ -1,11 +1,14 @@
 import json
 from dataclasses import dataclass, asdict, field
 import os
+import uuid
 
 @dataclass
 class ImageCollection:
     name: str
     directory_path: str
+    # This collection's database in the cache dir. Assigned the first time it's needed.
+    database_filename: str = None
 
 class Config:
     def __init__(self, data):
@@ -14,6 +17,13 @@ class Config:
         self.simple_configs = {}
         self.simple_configs["slideshow_delay"] = 3000
         self.simple_configs["images_per_page"] = 128
+        self.simple_configs["ingest_mode"] = "process" # "process" or "thread"
+        self.simple_configs["watch_folders"] = True # Pick up new images while a collection is open
+        self.simple_configs["poll_folders"] = False # Rescan watched folders where there's no inotify, e.g. on Windows
+        self.simple_configs["folder_poll_seconds"] = 300 # At least this long between those rescans
+        self.simple_configs["infinite_scroll"] = False # Scroll through the gallery instead of paging
+        self.simple_configs["viewer_cache_mb"] = 256 # Decoded images kept for the image viewer
+        self.simple_configs["thumbnail_format"] = "JPEG" # "JPEG" or "WEBP", for newly made thumbnails
 
         if "collections" in data:
             for collection_data in data['collections']:
@@ -72,6 +82,12 @@ class Configurations:
                     del self.config.collections[i]
         self.__save()
 
+    def get_database_filename(self, image_collection: ImageCollection):
+        if image_collection.database_filename is None:
+            image_collection.database_filename = f"collection_{uuid.uuid4().hex}.sqlite3"
+            self.__save()
+        return image_collection.database_filename
+
     def get_config(self, key):
         return self.config.simple_configs[key]
     def set_config(self, key, value):
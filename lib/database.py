@@ -1,19 +1,65 @@
-from dataclasses import asdict, dataclass
-import json
+from dataclasses import dataclass
+import itertools
+import queue
+import re
 import sqlite3
 import os
-from contextlib import closing
+import threading
+from contextlib import closing, contextmanager
+from typing import Dict, Iterator, List, Set, Tuple
 
 from lib.png_data import PngData
+import lib.database_schema as schema
+import lib.png_data_codec as codec
 from PIL import Image
 
+# Stay well under SQLite's limit on bound parameters
+MAX_QUERY_PARAMETERS = 500
+
+MAX_READ_CONNECTIONS = 4
+# The writer thread commits at most this many queued statements per transaction
+MAX_WRITE_BATCH_SIZE = 1000
+
+QUEUE_WRITE = 0
+QUEUE_UPSERT = 1
+QUEUE_FLUSH = 2
+QUEUE_STOP = 3
+
+UPSERT_IMAGE = """
+    INSERT INTO images (image_path, metadata, file_size, file_mtime, timestamp, checkpoint, favorite) VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (image_path) DO UPDATE SET
+        metadata = excluded.metadata,
+        file_size = COALESCE(excluded.file_size, file_size),
+        file_mtime = COALESCE(excluded.file_mtime, file_mtime),
+        timestamp = excluded.timestamp,
+        checkpoint = excluded.checkpoint,
+        favorite = excluded.favorite
+"""
+
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL", # Readers don't block the writer and vice versa
+    "PRAGMA synchronous = NORMAL", # Safe with WAL; only skips the fsync on each commit
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536", # 64 MB
+    "PRAGMA mmap_size = 268435456", # 256 MB
+    "PRAGMA busy_timeout = 5000",
+]
+
 @dataclass
 class DiskCacheEntry:
     image_path: str
     png_data: PngData
+    # The fingerprint of the file when it was parsed. None keeps the stored fingerprint.
+    file_size: int = None
+    file_mtime: float = None
 
 
 class Database:
+    """
+    All writes go through a queue to a single writer thread, which applies them in batched
+    transactions. Reads use a small pool of long-lived connections. Call flush() when a read
+    must see earlier writes, and close() before exiting.
+    """
     def __init__(self, cache_dir, database_filename):
         self.database_filename = database_filename
         self.cache_dir = cache_dir
@@ -21,39 +67,290 @@ class Database:
 
         self.try_create_database()
 
-    def try_create_database(self):
-        if (os.path.exists(self.database_path)):
+        self.__read_connections = queue.Queue()
+        self.__read_connection_count = 0
+        self.__read_connection_lock = threading.Lock()
+
+        self.__write_queue = queue.Queue()
+        self.__is_writing = True # Cleared once the writer has exited, so nothing waits on it after that
+        self.__signal_lock = threading.Lock()
+        self.__writer = threading.Thread(target=self.__write_loop, daemon=True)
+        self.__writer.start()
+
+    def __connect(self):
+        connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        return connection
+
+    @contextmanager
+    def __reader(self):
+        try:
+            connection = self.__read_connections.get_nowait()
+        except queue.Empty:
+            with self.__read_connection_lock:
+                can_connect = self.__read_connection_count < MAX_READ_CONNECTIONS
+                if can_connect:
+                    self.__read_connection_count += 1
+            connection = self.__connect() if can_connect else self.__read_connections.get()
+        try:
+            yield connection
+        finally:
+            self.__read_connections.put(connection)
+
+    def __write(self, sql, params_list):
+        self.__write_queue.put((QUEUE_WRITE, sql, params_list))
+
+    def __apply_upserts(self, cursor, upserts, tag_ids):
+        cursor.executemany(UPSERT_IMAGE, [row for row, tags, prompts in upserts])
+        # Replace each image's tags and prompt index row, in queue order so the last upsert of an image wins
+        prompts_by_id = {}
+        for row, tags, prompts in upserts:
+            image_id = cursor.execute("SELECT id FROM images WHERE image_path = ?", (row[0],)).fetchone()[0]
+            cursor.execute("DELETE FROM image_tags WHERE image_id = ?", (image_id,))
+            cursor.executemany("INSERT OR IGNORE INTO image_tags (tag_id, image_id) VALUES (?, ?)",
+                               [(schema.get_tag_id(cursor, tag, tag_ids), image_id) for tag in tags])
+            prompts_by_id[image_id] = prompts
+        cursor.executemany("DELETE FROM images_fts WHERE rowid = ?", [(image_id,) for image_id in prompts_by_id])
+        cursor.executemany(schema.INSERT_PROMPT_INDEX, [(image_id, *prompts) for image_id, prompts in prompts_by_id.items()])
+
+    def __write_loop(self):
+        connection = None
+        batch = []
+        try:
+            connection = self.__connect()
+            tag_ids = {} # Tag name -> id, so upserts don't look up every tag every time
+            is_running = True
+            while is_running:
+                batch = [self.__write_queue.get()]
+                while len(batch) < MAX_WRITE_BATCH_SIZE:
+                    try:
+                        batch.append(self.__write_queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                # Everything drained so far is one transaction. Runs of the same statement
+                # go through a single executemany, in queue order.
+                writes = [item for item in batch if item[0] in (QUEUE_WRITE, QUEUE_UPSERT)]
+                try:
+                    with closing(connection.cursor()) as cursor:
+                        for (kind, sql), run in itertools.groupby(writes, key=lambda item: (item[0], item[1])):
+                            params_list = [params for item in run for params in item[2]]
+                            if kind == QUEUE_UPSERT:
+                                self.__apply_upserts(cursor, params_list, tag_ids)
+                            else:
+                                cursor.executemany(sql, params_list)
+                    connection.commit()
+                except Exception as e:
+                    # Only this batch is lost. The writer keeps going, or flush() and close() would wait forever.
+                    print(f"ERROR: Database write failed: {e}")
+                    connection.rollback()
+                    tag_ids.clear() # Newly created tags were rolled back too
+
+                for item in batch:
+                    if item[0] in (QUEUE_WRITE, QUEUE_UPSERT):
+                        continue
+                    item[1].set()
+                    if item[0] == QUEUE_STOP:
+                        is_running = False
+        finally:
+            # Wake everyone waiting on a writer that's gone, whether it stopped or failed
+            with self.__signal_lock:
+                self.__is_writing = False
+            while True:
+                for item in batch:
+                    if item[0] in (QUEUE_FLUSH, QUEUE_STOP):
+                        item[1].set()
+                try:
+                    batch = [self.__write_queue.get_nowait()]
+                except queue.Empty:
+                    break
+            if connection is not None:
+                connection.close()
+
+    def __signal(self, kind):
+        event = threading.Event()
+        with self.__signal_lock:
+            if not self.__is_writing:
+                return
+            self.__write_queue.put((kind, event))
+        event.wait()
+
+    def flush(self):
+        """Blocks until every write queued so far has been committed."""
+        self.__signal(QUEUE_FLUSH)
+
+    def close(self):
+        if not self.__writer.is_alive():
             return
-        
+        self.__signal(QUEUE_STOP)
+        while True:
+            try:
+                self.__read_connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def try_create_database(self):
         with closing(sqlite3.connect(self.database_path)) as connection:
-            with closing(connection.cursor()) as cursor:
-                cursor.execute("CREATE TABLE images (image_path TEXT PRIMARY KEY, metadata BLOB)")
+            schema.create_or_migrate(connection)
+
+    @staticmethod
+    def prefix_range(directory):
+        # image_path BETWEEN these can use the primary key index, unlike LIKE 'dir%'.
+        # The trailing separator keeps "dir" from matching "dir2".
+        prefix = os.path.join(directory, "")
+        return (prefix, prefix + "\U0010ffff")
 
     def get(self, image_path: str) -> PngData:
-         with closing(sqlite3.connect(self.database_path)) as connection:
+        with self.__reader() as connection:
             with closing(connection.cursor()) as cursor:
                 rows = cursor.execute("SELECT image_path, metadata FROM images WHERE image_path = ?", (image_path,)).fetchall()
                 if len(rows) == 0:
                     return None
-                json_metadata = json.loads(rows[0][1])
-                return PngData(**json_metadata)
+                return codec.decode(rows[0][1], image_path)
 
     def upsert(self, data: DiskCacheEntry):
-        metadata = json.dumps(asdict(data.png_data), indent=4)
+        png_data = data.png_data
+        metadata = codec.encode(png_data)
+        row = (data.image_path, metadata, data.file_size, data.file_mtime, png_data.timestamp, png_data.checkpoint, png_data.favorite)
+        self.__write_queue.put((QUEUE_UPSERT, None, [(row, png_data.tags or [], schema.prompt_index_values(png_data))]))
 
-        with closing(sqlite3.connect(self.database_path)) as connection:
+    def stream_collection(self, directory) -> Iterator[Tuple[PngData, tuple]]:
+        """
+        Yields (png_data, (file_size, file_mtime)) for every image under directory, newest first,
+        from a single query. Rows are decoded as they're read, so nothing is buffered up front.
+        """
+        with self.__reader() as connection:
             with closing(connection.cursor()) as cursor:
-                cursor.execute("REPLACE INTO images VALUES (?, ?)", (data.image_path, metadata))
-                connection.commit()
+                cursor.execute("SELECT image_path, metadata, file_size, file_mtime FROM images WHERE image_path BETWEEN ? AND ? ORDER BY timestamp DESC", self.prefix_range(directory))
+                for image_path, metadata, file_size, file_mtime in cursor:
+                    yield (codec.decode(metadata, image_path), (file_size, file_mtime))
 
-    def delete_by_prefix(self, directory):
-        with closing(sqlite3.connect(self.database_path)) as connection:
+    def get_change_count(self) -> int:
+        """How many times images has been written to. A snapshot taken at one count is current while it stays the same."""
+        with self.__reader() as connection:
+            return connection.execute("SELECT changes FROM change_counter").fetchone()[0]
+
+    def set_fingerprints(self, fingerprints: Dict[str, tuple]):
+        self.__write("UPDATE images SET file_size = ?, file_mtime = ? WHERE image_path = ?",
+                     [(file_size, file_mtime, image_path) for image_path, (file_size, file_mtime) in fingerprints.items()])
+
+    def get_thumbnails(self, image_paths: List[str], tier: int) -> Dict[str, Tuple[int, bytes]]:
+        """
+        Returns {image_path: (tier, thumbnail)}, with each image's thumbnail at tier, or at the closest
+        tier it has so far. Images without any thumbnail are left out.
+        """
+        thumbnails = {}
+        with self.__reader() as connection:
+            with closing(connection.cursor()) as cursor:
+                for i in range(0, len(image_paths), MAX_QUERY_PARAMETERS):
+                    batch = image_paths[i:i + MAX_QUERY_PARAMETERS]
+                    placeholders = ",".join("?" * len(batch))
+                    # The subquery only reads the primary key index, so only the chosen blobs are loaded
+                    rows = cursor.execute(f"""
+                        SELECT image_path, tier, data FROM thumbnails AS chosen WHERE image_path IN ({placeholders}) AND tier = (
+                            SELECT tier FROM thumbnails WHERE image_path = chosen.image_path ORDER BY ABS(tier - ?), tier DESC LIMIT 1
+                        )
+                    """, (*batch, tier))
+                    thumbnails.update((image_path, (tier, data)) for image_path, tier, data in rows)
+        return thumbnails
+
+    def get_thumbnail_paths(self, tier: int) -> Set[str]:
+        """Returns the images that have a thumbnail at tier."""
+        with self.__reader() as connection:
             with closing(connection.cursor()) as cursor:
-                cursor.execute("DELETE FROM images WHERE image_path LIKE ?", (directory + '%',))
-                connection.commit()
+                return set(row[0] for row in cursor.execute("SELECT image_path FROM thumbnails WHERE tier = ?", (tier,)))
+
+    def upsert_thumbnails(self, image_path: str, thumbnails: Dict[int, bytes], format="JPEG"):
+        """Stores thumbnails, {tier: thumbnail}, leaving the image's other tiers as they are."""
+        self.__write("REPLACE INTO thumbnails (image_path, tier, format, data) VALUES (?, ?, ?, ?)",
+                     [(image_path, tier, format, thumbnail) for tier, thumbnail in thumbnails.items()])
+
+    def delete_thumbnails(self, image_paths: List[str]):
+        """Drops every tier of the images' thumbnails, e.g. because their files changed."""
+        self.__write("DELETE FROM thumbnails WHERE image_path = ?", [(image_path,) for image_path in image_paths])
 
     def delete(self, image_path):
-        with closing(sqlite3.connect(self.database_path)) as connection:
+        self.delete_many([image_path])
+
+    def delete_many(self, image_paths: List[str]):
+        self.__write("DELETE FROM image_tags WHERE image_id = (SELECT id FROM images WHERE image_path = ?)", [(image_path,) for image_path in image_paths])
+        self.__write("DELETE FROM images_fts WHERE rowid = (SELECT id FROM images WHERE image_path = ?)", [(image_path,) for image_path in image_paths])
+        self.__write("DELETE FROM images WHERE image_path = ?", [(image_path,) for image_path in image_paths])
+        self.delete_thumbnails(image_paths)
+
+    def __match_prompts(self, sql, query, params=()):
+        # Queries are FTS5 syntax: "phrases", NEAR(a b, 5), column filters like negative_prompt: x, and prefix*.
+        # Anything that doesn't parse, like a comma-separated prompt, is searched as plain words instead.
+        with self.__reader() as connection:
             with closing(connection.cursor()) as cursor:
-                cursor.execute("DELETE FROM images WHERE image_path = ?", (image_path,))
-                connection.commit()
+                try:
+                    return cursor.execute(sql, (query, *params)).fetchall()
+                except sqlite3.OperationalError:
+                    words = _quote_words(query)
+                    return cursor.execute(sql, (words, *params)).fetchall() if words else []
+
+    def search_prompts(self, query: str, limit: int, offset: int = 0) -> List[str]:
+        """Returns a page of the images whose prompts, checkpoint or LoRAs match query, best match first."""
+        rows = self.__match_prompts("""
+            SELECT images.image_path FROM images_fts
+            JOIN images ON images.id = images_fts.rowid
+            WHERE images_fts MATCH ? ORDER BY images_fts.rank LIMIT ? OFFSET ?
+        """, query, (limit, offset))
+        return [row[0] for row in rows]
+
+    def count_prompt_matches(self, query: str) -> int:
+        rows = self.__match_prompts("SELECT COUNT(*) FROM images_fts WHERE images_fts MATCH ?", query)
+        return rows[0][0] if rows else 0
+
+def _quote_words(query: str) -> str:
+    return " ".join('"' + word.replace('"', '""') + '"' for word in re.split(r"[\s,]+", query) if word)
+
+def delete_database(cache_dir, database_filename):
+    """Deletes a database file, along with its WAL files. The database must be closed first."""
+    database_path = os.path.join(cache_dir, database_filename)
+    for path in (database_path, database_path + "-wal", database_path + "-shm"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def split_shared_database(cache_dir, shared_filename, database_filenames: Dict[str, str]):
+    """
+    Copies each collection's rows out of the database that all collections used to share, into
+    that collection's own database, then deletes the shared one. database_filenames is
+    {directory_path: database_filename}. Rows outside every collection are dropped.
+    """
+    shared_path = os.path.join(cache_dir, shared_filename)
+    Database(cache_dir, shared_filename).close() # Brings it up to the current schema first
+    for directory, database_filename in database_filenames.items():
+        print(f"Moving {directory} into {database_filename}...")
+        with closing(sqlite3.connect(os.path.join(cache_dir, database_filename))) as connection:
+            schema.create_or_migrate(connection)
+            connection.execute("ATTACH DATABASE ? AS shared", (shared_path,))
+            # Ids are kept as they are, so image_tags can be copied straight across
+            connection.execute("""
+                INSERT OR IGNORE INTO main.images (id, image_path, metadata, file_size, file_mtime, timestamp, checkpoint, favorite)
+                SELECT id, image_path, metadata, file_size, file_mtime, timestamp, checkpoint, favorite
+                FROM shared.images WHERE image_path BETWEEN ? AND ?
+            """, Database.prefix_range(directory))
+            connection.execute("""
+                INSERT OR IGNORE INTO main.image_tags (tag_id, image_id)
+                SELECT tag_id, image_id FROM shared.image_tags WHERE image_id IN (SELECT id FROM main.images)
+            """)
+            connection.execute("""
+                INSERT OR IGNORE INTO main.tags (id, name)
+                SELECT id, name FROM shared.tags WHERE id IN (SELECT tag_id FROM main.image_tags)
+            """)
+            connection.execute("""
+                INSERT INTO main.images_fts (rowid, positive_prompt, negative_prompt, checkpoint, loras)
+                SELECT rowid, positive_prompt, negative_prompt, checkpoint, loras FROM shared.images_fts
+                WHERE rowid IN (SELECT id FROM main.images) AND rowid NOT IN (SELECT rowid FROM main.images_fts)
+            """)
+            connection.execute("""
+                INSERT OR IGNORE INTO main.thumbnails (image_path, tier, format, data)
+                SELECT image_path, tier, format, data FROM shared.thumbnails WHERE image_path BETWEEN ? AND ?
+            """, Database.prefix_range(directory))
+            connection.commit()
+            connection.execute("DETACH DATABASE shared")
+    delete_database(cache_dir, shared_filename)
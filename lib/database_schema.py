@@ -0,0 +1,198 @@
+import base64
+import json
+import sqlite3
+from contextlib import closing
+
+import lib.png_data_codec as codec
+
+# Stored in PRAGMA user_version
+# 0: Thumbnails are base64 inside the metadata JSON
+# 1: Thumbnails are raw bytes in their own table
+# 2: Images have a file_size/file_mtime fingerprint, for incremental rescans
+# 3: Images have an indexed timestamp column, so collections can be streamed newest first
+# 4: Images have integer ids plus checkpoint/favorite columns, and tags are normalized into tags/image_tags
+# 5: Metadata is in the compact binary format from png_data_codec instead of indented JSON
+# 6: Prompts, checkpoints and LoRAs have an FTS5 full-text index, images_fts
+# 7: Thumbnails are stored at several sizes, keyed by (image_path, tier)
+# 8: Triggers count every change to images, so a collection snapshot can tell when it's out of date
+SCHEMA_VERSION = 8
+
+CREATE_STATEMENTS = [
+    """CREATE TABLE images (
+        id INTEGER PRIMARY KEY,
+        image_path TEXT NOT NULL UNIQUE,
+        metadata BLOB,
+        file_size INTEGER,
+        file_mtime REAL,
+        timestamp REAL,
+        checkpoint TEXT,
+        favorite INTEGER NOT NULL DEFAULT 0
+    )""",
+    "CREATE INDEX images_timestamp ON images (timestamp)",
+    "CREATE INDEX images_checkpoint ON images (checkpoint, timestamp)",
+    "CREATE INDEX images_favorite ON images (timestamp) WHERE favorite = 1",
+
+    # Models and LoRAs are tags too, prefixed with "model:" and "lora:"
+    "CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)",
+    # Both directions are covering indexes, so neither lookup touches the images table
+    "CREATE TABLE image_tags (tag_id INTEGER NOT NULL, image_id INTEGER NOT NULL, PRIMARY KEY (tag_id, image_id)) WITHOUT ROWID",
+    "CREATE INDEX image_tags_image ON image_tags (image_id, tag_id)",
+]
+
+# tier is the thumbnail's longest side, one of image_helpers.THUMBNAIL_TIERS
+CREATE_THUMBNAILS = "CREATE TABLE IF NOT EXISTS thumbnails (image_path TEXT NOT NULL, tier INTEGER NOT NULL, format TEXT, data BLOB, PRIMARY KEY (image_path, tier))"
+
+# The rowid of each row is the id of its image. LoRA names are stored space-separated.
+CREATE_PROMPT_INDEX = "CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(positive_prompt, negative_prompt, checkpoint, loras)"
+INSERT_PROMPT_INDEX = "INSERT INTO images_fts (rowid, positive_prompt, negative_prompt, checkpoint, loras) VALUES (?, ?, ?, ?, ?)"
+
+# A single row, bumped on every insert, update or delete of an image. Tags only change along with an
+# upsert of their image, so images is the only table that needs watching.
+CREATE_CHANGE_COUNTER = [
+    "CREATE TABLE IF NOT EXISTS change_counter (id INTEGER PRIMARY KEY CHECK (id = 0), changes INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO change_counter VALUES (0, 0)",
+    "CREATE TRIGGER IF NOT EXISTS images_inserted AFTER INSERT ON images BEGIN UPDATE change_counter SET changes = changes + 1; END",
+    "CREATE TRIGGER IF NOT EXISTS images_updated AFTER UPDATE ON images BEGIN UPDATE change_counter SET changes = changes + 1; END",
+    "CREATE TRIGGER IF NOT EXISTS images_deleted AFTER DELETE ON images BEGIN UPDATE change_counter SET changes = changes + 1; END",
+]
+
+def create_or_migrate(connection: sqlite3.Connection):
+    with closing(connection.cursor()) as cursor:
+        has_images = cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'images'").fetchone()
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        if not has_images:
+            for statement in CREATE_STATEMENTS:
+                cursor.execute(statement)
+            cursor.execute(CREATE_THUMBNAILS)
+            cursor.execute(CREATE_PROMPT_INDEX)
+            for statement in CREATE_CHANGE_COUNTER:
+                cursor.execute(statement)
+        else:
+            if version < 1:
+                _migrate_thumbnails(connection)
+            if version < 2:
+                _migrate_fingerprints(connection)
+            if version < 3:
+                _migrate_timestamps(connection)
+            if version < 4:
+                _migrate_normalized_tags(connection)
+            if version < 5:
+                _migrate_binary_metadata(connection)
+            if version < 6:
+                _migrate_prompt_index(connection)
+            if version < 7:
+                _migrate_thumbnail_tiers(connection)
+            if version < 8:
+                for statement in CREATE_CHANGE_COUNTER:
+                    cursor.execute(statement)
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        connection.commit()
+
+def _columns(connection, table):
+    return [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+
+def _migrate_thumbnails(connection):
+    # Moves base64 thumbnails out of the metadata JSON into the thumbnails table as raw JPEG bytes
+    connection.execute("CREATE TABLE IF NOT EXISTS thumbnails (image_path TEXT PRIMARY KEY, format TEXT, data BLOB)")
+    migrated = 0
+    with closing(connection.cursor()) as read_cursor, closing(connection.cursor()) as write_cursor:
+        read_cursor.execute("SELECT image_path, metadata FROM images")
+        for image_path, metadata in read_cursor:
+            json_metadata = json.loads(metadata)
+            thumbnail_base64 = json_metadata.pop("thumbnail_base64", None)
+            if thumbnail_base64 is None:
+                continue
+            if thumbnail_base64:
+                write_cursor.execute("REPLACE INTO thumbnails VALUES (?, ?, ?)", (image_path, "JPEG", base64.b64decode(thumbnail_base64)))
+            write_cursor.execute("UPDATE images SET metadata = ? WHERE image_path = ?", (json.dumps(json_metadata, indent=4), image_path))
+            migrated += 1
+    connection.commit()
+    if migrated > 0:
+        print(f"Moved {migrated} thumbnails out of the metadata. Compacting the database...")
+        connection.execute("VACUUM")
+
+def _migrate_fingerprints(connection):
+    # Old rows get NULL fingerprints, which the next rescan fills in
+    columns = _columns(connection, "images")
+    if "file_size" not in columns:
+        connection.execute("ALTER TABLE images ADD COLUMN file_size INTEGER")
+    if "file_mtime" not in columns:
+        connection.execute("ALTER TABLE images ADD COLUMN file_mtime REAL")
+
+def _migrate_timestamps(connection):
+    if "timestamp" not in _columns(connection, "images"):
+        connection.execute("ALTER TABLE images ADD COLUMN timestamp REAL")
+    connection.execute("UPDATE images SET timestamp = json_extract(metadata, '$.timestamp') WHERE timestamp IS NULL")
+
+def _migrate_normalized_tags(connection):
+    # Rebuilds images with an integer id, then fills the tag tables from each row's JSON tag list
+    print("Upgrading the database to the normalized tag schema...")
+    connection.execute("DROP INDEX IF EXISTS images_timestamp")
+    connection.execute("ALTER TABLE images RENAME TO images_v3")
+    for statement in CREATE_STATEMENTS:
+        connection.execute(statement)
+    connection.execute("""
+        INSERT INTO images (image_path, metadata, file_size, file_mtime, timestamp, checkpoint, favorite)
+        SELECT image_path, metadata, file_size, file_mtime, timestamp,
+            json_extract(metadata, '$.checkpoint'),
+            COALESCE(json_extract(metadata, '$.favorite'), 0)
+        FROM images_v3 ORDER BY timestamp
+    """)
+    connection.execute("DROP TABLE images_v3")
+    tag_ids = {}
+    with closing(connection.cursor()) as read_cursor, closing(connection.cursor()) as write_cursor:
+        read_cursor.execute("SELECT id, metadata FROM images")
+        for image_id, metadata in read_cursor:
+            tags = json.loads(metadata).get("tags") or []
+            write_cursor.executemany("INSERT OR IGNORE INTO image_tags (tag_id, image_id) VALUES (?, ?)",
+                                     [(get_tag_id(write_cursor, tag, tag_ids), image_id) for tag in tags])
+
+def _migrate_binary_metadata(connection):
+    print("Re-encoding metadata in the compact format...")
+    with closing(connection.cursor()) as read_cursor, closing(connection.cursor()) as write_cursor:
+        read_cursor.execute("SELECT id, image_path, metadata FROM images")
+        for image_id, image_path, metadata in read_cursor:
+            if codec.is_encoded(metadata):
+                continue
+            write_cursor.execute("UPDATE images SET metadata = ? WHERE id = ?", (codec.encode(codec.decode(metadata, image_path)), image_id))
+    connection.commit()
+    connection.execute("VACUUM")
+
+def _migrate_prompt_index(connection):
+    print("Building the prompt search index...")
+    connection.execute(CREATE_PROMPT_INDEX)
+    connection.execute("DELETE FROM images_fts")
+    with closing(connection.cursor()) as read_cursor, closing(connection.cursor()) as write_cursor:
+        read_cursor.execute("SELECT id, image_path, metadata FROM images")
+        for image_id, image_path, metadata in read_cursor:
+            write_cursor.execute(INSERT_PROMPT_INDEX, (image_id, *prompt_index_values(codec.decode(metadata, image_path))))
+    connection.commit()
+
+def _migrate_thumbnail_tiers(connection):
+    # Every thumbnail before tiers was 256px
+    connection.execute("ALTER TABLE thumbnails RENAME TO thumbnails_v6")
+    connection.execute(CREATE_THUMBNAILS)
+    migrated = connection.execute("INSERT INTO thumbnails (image_path, tier, format, data) SELECT image_path, 256, format, data FROM thumbnails_v6").rowcount
+    connection.execute("DROP TABLE thumbnails_v6")
+    connection.commit()
+    if migrated > 0:
+        print(f"Moved {migrated} thumbnails to the 256px tier. Compacting the database...")
+        connection.execute("VACUUM") # The old table's pages would otherwise stay in the file as free space
+
+def prompt_index_values(png_data) -> tuple:
+    """The images_fts columns for png_data, in order."""
+    return (png_data.positive_prompt or "", png_data.negative_prompt or "", png_data.checkpoint or "", " ".join(png_data.loras or []))
+
+def normalize_tag(tag: str) -> str:
+    # Same normalization as TagCache.add
+    return tag.strip().lower()
+
+def get_tag_id(cursor: sqlite3.Cursor, tag: str, tag_ids: dict) -> int:
+    """Looks up or creates the id of a tag. tag_ids caches the lookups for this connection."""
+    tag = normalize_tag(tag)
+    tag_id = tag_ids.get(tag)
+    if tag_id is None:
+        cursor.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
+        tag_id = cursor.execute("SELECT id FROM tags WHERE name = ?", (tag,)).fetchone()[0]
+        tag_ids[tag] = tag_id
+    return tag_id
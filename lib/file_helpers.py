@@ -1,4 +1,30 @@
 import os
 def with_extension(filename, extension):
     base_filename = os.path.splitext(os.path.basename(filename))[0]
-    return f"{base_filename}.{extension}"
\ No newline at end of file
+    return f"{base_filename}.{extension}"
+
+def is_image_file(filename):
+    return filename.lower().endswith(".png") and not os.path.basename(filename).startswith(".")
+
+def scan_images(dir_path):
+    """
+    Recursively lists the images under dir_path as {image_path: (file_size, file_mtime)}.
+    os.scandir gets the stat results from the directory listing itself on Windows, and
+    with a single stat per file elsewhere.
+    """
+    images = {}
+    pending = [dir_path]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError as e:
+            print(f"ERROR: Could not scan {e.filename}: {e}")
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif is_image_file(entry.name):
+                    stat = entry.stat()
+                    images[entry.path] = (stat.st_size, stat.st_mtime)
+    return images
\ No newline at end of file
@@ -0,0 +1,222 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from typing import Dict, Set
+
+import lib.file_helpers as filez
+
+# Changes are reported once a burst has been quiet for DEBOUNCE_SECONDS, or at the latest
+# MAX_BATCH_DELAY after its first event, so a generator writing non-stop still shows up
+DEBOUNCE_SECONDS = 1.0
+MAX_BATCH_DELAY = 5.0
+# A polled folder is rescanned after at least this many times as long as the last rescan took, so a slow
+# network share isn't kept busy being rescanned
+POLL_SCAN_MULTIPLE = 10
+# How often an idle watcher checks whether it has been stopped
+IDLE_TIMEOUT = 0.5
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# IN_CREATE only matters for directories. New files are picked up on IN_CLOSE_WRITE, once they're fully written.
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class _InotifyBackend:
+    """Linux only. Watches every directory under dir_path, adding new subdirectories as they appear."""
+    def __init__(self, dir_path):
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.__fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.__directories = {} # Watch descriptor -> directory
+        self.__add_watches(dir_path)
+
+    def __add_watches(self, dir_path):
+        for root, _, _ in os.walk(dir_path):
+            wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                print(f"ERROR: Could not watch {root}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self.__directories[wd] = root
+
+    def wait(self, timeout):
+        """Returns the paths that changed within timeout, or None if everything has to be rescanned."""
+        readable, _, _ = select.select([self.__fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            buffer = os.read(self.__fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        paths = set()
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                return None # Events were dropped
+            if mask & IN_IGNORED:
+                self.__directories.pop(wd, None)
+                continue
+            directory = self.__directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files can land in a new folder before it's watched, so list it now
+                    self.__add_watches(path)
+                    paths.update(filez.scan_images(path))
+                elif mask & IN_MOVED_FROM:
+                    return None # Everything that was under it is gone
+            elif filez.is_image_file(name) and not mask & IN_CREATE:
+                paths.add(path)
+        return paths
+
+    def close(self):
+        os.close(self.__fd)
+
+
+class _PollingBackend:
+    """Asks for a full rescan every poll_interval seconds, or POLL_SCAN_MULTIPLE times the last rescan if that's longer."""
+    def __init__(self, stop_event: threading.Event, poll_interval):
+        self.__stop_event = stop_event
+        self.__poll_interval = poll_interval
+        self.__next_scan = time.monotonic() + poll_interval
+        self.__scan_start = None
+
+    def wait(self, timeout):
+        now = time.monotonic()
+        if self.__scan_start is not None:
+            # The watcher rescans as soon as wait() returns None, so this is how long that took
+            self.__next_scan = now + max(self.__poll_interval, POLL_SCAN_MULTIPLE * (now - self.__scan_start))
+            self.__scan_start = None
+        remaining = self.__next_scan - now
+        if remaining > timeout:
+            self.__stop_event.wait(timeout)
+            return set()
+        self.__stop_event.wait(max(remaining, 0))
+        self.__scan_start = time.monotonic()
+        return None
+
+    def close(self):
+        pass
+
+
+class FolderWatcher:
+    """
+    Watches a collection folder for PNGs that are created, modified or deleted, and reports them in
+    debounced batches: func_on_changes({image_path: (file_size, file_mtime)}, [deleted_image_path]).
+    Uses inotify where available. Otherwise it polls the folder every poll_interval seconds, or doesn't
+    watch at all if poll_interval is None. Whatever changed since files was scanned is reported first.
+    The callback runs on the watcher's thread.
+    """
+    def __init__(self, dir_path, files: Dict[str, tuple], func_on_changes, poll_interval=None):
+        self.dir_path = dir_path
+        self.func_on_changes = func_on_changes
+        self.poll_interval = poll_interval
+        self.__files = dict(files) # The last known fingerprints, as returned by filez.scan_images
+        self.__stop_event = threading.Event()
+        self.__thread = None
+
+    def __create_backend(self):
+        if sys.platform.startswith("linux"):
+            try:
+                return _InotifyBackend(self.dir_path)
+            except (OSError, AttributeError) as e:
+                print(f"Could not use inotify for {self.dir_path}: {e}")
+        if self.poll_interval is None:
+            print(f"Not watching {self.dir_path}, since polling is turned off")
+            return None
+        print(f"Polling {self.dir_path} every {self.poll_interval}s or more")
+        return _PollingBackend(self.__stop_event, self.poll_interval)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    def __rescan(self) -> Set[str]:
+        files = filez.scan_images(self.dir_path)
+        changed = set(path for path, fingerprint in files.items() if self.__files.get(path) != fingerprint)
+        return changed | (self.__files.keys() - files.keys())
+
+    def __run(self):
+        backend = self.__create_backend()
+        if backend is None:
+            return
+        try:
+            # Catches up on whatever changed since files was scanned, e.g. while the collection was being parsed.
+            # The backend is already watching, so nothing slips in between.
+            dirty = self.__rescan()
+            first_event = time.monotonic() if dirty else None
+            last_event = first_event
+            while not self.__stop_event.is_set():
+                timeout = DEBOUNCE_SECONDS if first_event is not None else IDLE_TIMEOUT
+                paths = backend.wait(timeout)
+                if paths is None:
+                    # Paths that are already waiting to be reported would show up again, and keep the batch open
+                    paths = self.__rescan() - dirty
+                now = time.monotonic()
+                if paths:
+                    dirty |= paths
+                    last_event = now
+                    if first_event is None:
+                        first_event = now
+                if first_event is None or self.__stop_event.is_set():
+                    continue
+                if now - last_event >= DEBOUNCE_SECONDS or now - first_event >= MAX_BATCH_DELAY:
+                    self.__report(dirty)
+                    dirty = set()
+                    first_event = None
+        finally:
+            backend.close()
+
+    def __report(self, paths: Set[str]):
+        changed = {}
+        deleted = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                if self.__files.pop(path, None) is not None:
+                    deleted.append(path)
+                continue
+            except OSError as e:
+                print(f"ERROR: Could not stat {path}: {e}")
+                continue
+            fingerprint = (stat.st_size, stat.st_mtime)
+            if self.__files.get(path) != fingerprint:
+                self.__files[path] = fingerprint
+                changed[path] = fingerprint
+        if changed or deleted:
+            try:
+                self.func_on_changes(changed, deleted)
+            except Exception as e:
+                print(f"ERROR: Could not apply folder changes: {e}")
@@ -1,18 +1,71 @@
-
+from dataclasses import dataclass
 from lib.png_data import PngData
 from typing import List
 
+@dataclass(slots=True)
+class ImageSummary:
+    # What the galleries and collection snapshots need of an image, without its prompts
+    image_path: str
+    timestamp: float = 0
+    favorite: bool = False
+    checkpoint: str = ""
+    tag_count: int = 0
+    file_size: int = None
+    file_mtime: float = None
+
+
 class ImageCache:
-    def __init__(self):
+    """
+    PngData by path. Images restored from a CollectionSnapshot stay in its columns until something
+    needs more than their ImageSummary, and then func_load_png_data reads them from the database.
+    """
+    def __init__(self, func_load_png_data=None):
+        self.func_load_png_data = func_load_png_data # image_path -> PngData
         self.__image_index = {}  # Private inverted index
+        self.__snapshot = None
+        self.__snapshot_ids = {} # Path -> position in the snapshot, for the images that are only there
+
+    def restore(self, snapshot):
+        """Adds every image in a CollectionSnapshot, without decoding any of them."""
+        self.__snapshot = snapshot
+        self.__snapshot_ids = {image_path: i for i, image_path in enumerate(snapshot.image_paths) if image_path not in self.__image_index}
 
     def set(self, filename: str, data: PngData):
         if filename not in self.__image_index:
             self.__image_index[filename] = data  # Create a new entry for the image
+            self.__snapshot_ids.pop(filename, None)
         # Implement merge logic
 
+    def remove(self, filename: str) -> PngData:
+        if filename in self.__snapshot_ids:
+            self.get(filename) # Callers need its tags
+        return self.__image_index.pop(filename, None)
+
     def get(self, filename: str) -> PngData:
-        return self.__image_index.get(filename, None) 
-    
-    def get_all(self) -> List[PngData]:
-        return list(self.__image_index.values())
+        data = self.__image_index.get(filename)
+        if data is None and filename in self.__snapshot_ids:
+            data = self.func_load_png_data(filename)
+            del self.__snapshot_ids[filename]
+            if data is not None:
+                self.__image_index[filename] = data
+        return data
+
+    def get_summary(self, filename: str):
+        """The image's PngData if it's loaded, or else an ImageSummary from the snapshot. None if it isn't cached."""
+        data = self.__image_index.get(filename)
+        if data is not None:
+            return data
+        i = self.__snapshot_ids.get(filename)
+        if i is None:
+            return None
+        snapshot = self.__snapshot
+        return ImageSummary(
+            image_path=filename,
+            timestamp=snapshot.timestamps[i],
+            favorite=bool(snapshot.favorites[i]),
+            checkpoint=snapshot.checkpoints[snapshot.checkpoint_ids[i]],
+            tag_count=snapshot.tag_counts[i],
+        )
+
+    def get_paths(self) -> List[str]:
+        return [*self.__image_index.keys(), *self.__snapshot_ids.keys()]
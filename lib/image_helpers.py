@@ -1,11 +1,68 @@
 
 import base64
 from io import BytesIO
+from typing import Dict
+
 from PIL import Image
 
-def make_thumbnail_base64(image: Image) -> str:
-    membuf = BytesIO()
-    image = image.convert('RGB')
-    image.thumbnail((256, 256))  
-    image.save(membuf, format="JPEG", quality=85)
-    return base64.b64encode(membuf.getvalue()).decode('utf-8')
\ No newline at end of file
+# Thumbnails are stored at each of these sizes, so the gallery can send the smallest one that fills its tiles
+THUMBNAIL_TIERS = (128, 256, 512)
+# Made as soon as an image is indexed. The larger tiers are only made once the gallery is zoomed in that far.
+EAGER_THUMBNAIL_TIERS = (128, 256)
+
+# Thumbnail encodings, chosen with "thumbnail_format" in the config. WebP is smaller but slower to encode.
+THUMBNAIL_FORMAT_JPEG = "JPEG"
+THUMBNAIL_FORMAT_WEBP = "WEBP"
+THUMBNAIL_SAVE_OPTIONS = {
+    THUMBNAIL_FORMAT_JPEG: {"quality": 85},
+    THUMBNAIL_FORMAT_WEBP: {"quality": 80, "method": 4},
+}
+
+def make_thumbnails(image: Image, tiers=EAGER_THUMBNAIL_TIERS, format=THUMBNAIL_FORMAT_JPEG) -> Dict[int, bytes]:
+    """Returns {tier: encoded thumbnail}. Each tier is shrunk from the one above it rather than from the original."""
+    largest = max(tiers)
+    image.draft("RGB", (largest, largest)) # Only JPEGs can decode at a smaller size
+    if image.mode != "RGB":
+        # RGB images skip the full-sized copy. Others convert first, since resizing with alpha costs more than this.
+        image = image.convert("RGB")
+    thumbnails = {}
+    for tier in sorted(tiers, reverse=True):
+        image.thumbnail((tier, tier), reducing_gap=2.0) # Shrinks by a whole factor with reduce() before resampling
+        membuf = BytesIO()
+        image.save(membuf, format=format, **THUMBNAIL_SAVE_OPTIONS[format])
+        thumbnails[tier] = membuf.getvalue()
+    return thumbnails
+
+
+def load_thumbnails(image_path: str, tiers=EAGER_THUMBNAIL_TIERS, format=THUMBNAIL_FORMAT_JPEG) -> Dict[int, bytes]:
+    with Image.open(image_path) as image:
+        return make_thumbnails(image, tiers, format)
+
+
+def thumbnail_tier(extent) -> int:
+    """The smallest tier that covers extent pixels, or the largest one."""
+    for tier in THUMBNAIL_TIERS:
+        if tier >= extent:
+            return tier
+    return THUMBNAIL_TIERS[-1]
+
+
+def closest_tier(tiers, tier) -> int:
+    """Whichever of tiers is closest to tier, the larger one on a tie."""
+    return min(tiers, key=lambda t: (abs(t - tier), -t))
+
+
+def to_base64(data: bytes) -> str:
+    return base64.b64encode(data).decode('utf-8')
+
+def load_display_image(image_path: str, max_size) -> bytes:
+    """The image shrunk to fit max_size (width, height), as a JPEG for the viewer."""
+    with Image.open(image_path) as image:
+        image.draft("RGB", max_size) # Only JPEGs can decode at a smaller size
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB") # Cheaper than resizing with alpha
+        if image.width > max_size[0] or image.height > max_size[1]:
+            image.thumbnail(max_size, reducing_gap=2.0)
+        membuf = BytesIO()
+        image.save(membuf, format="JPEG", quality=92)
+        return membuf.getvalue()
@@ -0,0 +1,54 @@
+import concurrent.futures
+import os
+from typing import Iterator, List
+
+from lib.png_data import PngData
+from lib.png_parser import PngParser
+
+INGEST_MODE_THREAD = "thread"
+INGEST_MODE_PROCESS = "process"
+
+CHUNK_SIZE = 32
+
+# Each worker process keeps its own parser
+_worker_parser = None
+
+def parse_chunk(image_paths: List[str]) -> List[PngData]:
+    # Runs inside a worker process. PngData is a plain dataclass, so it pickles back cheaply.
+    global _worker_parser
+    if _worker_parser is None:
+        _worker_parser = PngParser()
+    return [_worker_parser.parse(image_path) for image_path in image_paths]
+
+def chunked(items: List, chunk_size: int) -> Iterator[List]:
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+class ProcessIngestEngine:
+    """
+    Parses images in a pool of worker processes, since tag extraction and json.loads
+    of ComfyUI workflows are GIL-bound. Paths are submitted in chunks to keep IPC overhead low.
+    Workers only parse; the caller does all the cache and database writes.
+    """
+    def __init__(self, max_workers=None, chunk_size=CHUNK_SIZE):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.executor = None # Created lazily, so spawning processes doesn't slow down startup
+
+    def __get_executor(self):
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+        return self.executor
+
+    def parse(self, image_paths: List[str]) -> Iterator[List[PngData]]:
+        """Yields lists of parsed PngData, one per chunk, in completion order."""
+        executor = self.__get_executor()
+        futures = [executor.submit(parse_chunk, chunk) for chunk in chunked(image_paths, self.chunk_size)]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,64 @@
+import struct
+import zlib
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+TEXT_CHUNK_TYPES = (b"tEXt", b"zTXt", b"iTXt")
+METADATA_KEYS = ("parameters", "workflow")
+
+class PngChunkError(Exception):
+    pass
+
+def _decode_text(data: bytes):
+    keyword, text = data.split(b"\0", 1)
+    return keyword.decode("latin-1"), text.decode("latin-1", "replace")
+
+def _decode_ztxt(data: bytes):
+    keyword, rest = data.split(b"\0", 1)
+    # rest[0] is the compression method, which is always zlib
+    return keyword.decode("latin-1"), zlib.decompress(rest[1:]).decode("latin-1", "replace")
+
+def _decode_itxt(data: bytes):
+    keyword, rest = data.split(b"\0", 1)
+    compressed, rest = rest[0], rest[2:]
+    language, rest = rest.split(b"\0", 1)
+    translated_keyword, text = rest.split(b"\0", 1)
+    if compressed:
+        text = zlib.decompress(text)
+    return keyword.decode("latin-1"), text.decode("utf-8", "replace")
+
+_DECODERS = {
+    b"tEXt": _decode_text,
+    b"zTXt": _decode_ztxt,
+    b"iTXt": _decode_itxt,
+}
+
+def read_text_chunks(image_path: str, wanted_keys=METADATA_KEYS) -> dict:
+    """
+    Reads the tEXt/zTXt/iTXt chunks of a PNG without decompressing any pixel data.
+    Stops at the first IDAT once one of wanted_keys has been found. Otherwise it seeks
+    over the image data (without reading it) in case the metadata was written after it.
+    """
+    info = {}
+    with open(image_path, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            raise PngChunkError(f"Not a PNG file: {image_path}")
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break # Truncated file; return whatever we found
+            length, chunk_type = struct.unpack(">I4s", header)
+            if chunk_type == b"IEND":
+                break
+            if chunk_type == b"IDAT" and any(key in info for key in wanted_keys):
+                break
+            if chunk_type in TEXT_CHUNK_TYPES:
+                data = f.read(length)
+                f.seek(4, 1) # CRC
+                try:
+                    key, value = _DECODERS[chunk_type](data)
+                except (ValueError, IndexError, zlib.error):
+                    continue # Skip malformed chunks, like PIL does
+                info[key] = value
+            else:
+                f.seek(length + 4, 1) # Chunk data and CRC
+    return info
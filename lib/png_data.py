@@ -9,7 +9,10 @@ class PngData:
     positive_prompt: str = ""
     negative_prompt: str = ""
     tags: list[str] = None
-    thumbnail_base64: str = ""
     timestamp: float = ""
     raw_data: str = ""
-    error: str = ""
\ No newline at end of file
+    error: str = ""
+
+    @property
+    def tag_count(self) -> int:
+        return len(self.tags or [])
@@ -0,0 +1,90 @@
+import itertools
+import json
+import struct
+import zlib
+
+from lib.png_data import PngData
+
+# Binary layout, all little-endian:
+#   header: magic "PD", format version, flags, timestamp (double), lora count, tag count, raw_data field count
+#   then the length in characters of every string field, as uint32s
+#   then the string fields concatenated into one UTF-8 block, zlib-compressed if FLAG_COMPRESSED:
+#   checkpoint, loras, tags, positive_prompt, negative_prompt, error, then raw_data
+# raw_data is normally the PNG's text chunks, so it's stored as alternating keys and values and needs no
+# parsing. Anything else is stored as one JSON field, with FLAG_RAW_JSON.
+# The image path isn't stored, since it's already the row's key.
+MAGIC = b"PD"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<2sBBdIII")
+
+FLAG_FAVORITE = 1
+FLAG_COMPRESSED = 2
+FLAG_RAW_JSON = 4
+
+# Below this, zlib's overhead isn't worth it
+COMPRESS_THRESHOLD = 1024
+
+def _is_text_dict(value) -> bool:
+    return isinstance(value, dict) and all(isinstance(k, str) and isinstance(v, str) for k, v in value.items())
+
+def encode(png_data: PngData) -> bytes:
+    loras = png_data.loras or []
+    tags = png_data.tags or []
+    flags = FLAG_FAVORITE if png_data.favorite else 0
+    if _is_text_dict(png_data.raw_data):
+        raw_fields = [field for item in png_data.raw_data.items() for field in item]
+    else:
+        raw_fields = [json.dumps(png_data.raw_data, separators=(",", ":"), default=str)]
+        flags |= FLAG_RAW_JSON
+    fields = [png_data.checkpoint or "", *loras, *tags,
+              png_data.positive_prompt or "", png_data.negative_prompt or "", png_data.error or "", *raw_fields]
+
+    body = "".join(fields).encode("utf-8")
+    if len(body) >= COMPRESS_THRESHOLD:
+        body = zlib.compress(body, 6)
+        flags |= FLAG_COMPRESSED
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, flags, float(png_data.timestamp or 0), len(loras), len(tags), len(raw_fields))
+    lengths = struct.pack(f"<{len(fields)}I", *[len(field) for field in fields])
+    return header + lengths + body
+
+def is_encoded(data) -> bool:
+    return isinstance(data, bytes) and data[:2] == MAGIC
+
+def decode(data, image_path: str) -> PngData:
+    """Decodes metadata in either this format or the legacy JSON format."""
+    if not is_encoded(data):
+        return PngData(**json.loads(data))
+
+    magic, version, flags, timestamp, lora_count, tag_count, raw_count = HEADER.unpack_from(data, 0)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unknown metadata format version {version} for {image_path}")
+    field_count = lora_count + tag_count + raw_count + 4
+    lengths = struct.unpack_from(f"<{field_count}I", data, HEADER.size)
+    body = data[HEADER.size + 4 * field_count:]
+    if flags & FLAG_COMPRESSED:
+        body = zlib.decompress(body)
+    text = body.decode("utf-8")
+
+    ends = list(itertools.accumulate(lengths))
+    fields = [text[start:end] for start, end in zip([0] + ends, ends)]
+    tags_end = 1 + lora_count + tag_count
+    positive_prompt, negative_prompt, error = fields[tags_end:tags_end + 3]
+    raw_fields = fields[tags_end + 3:]
+    if flags & FLAG_RAW_JSON:
+        raw_data = json.loads(raw_fields[0])
+    else:
+        raw_data = dict(zip(raw_fields[::2], raw_fields[1::2]))
+
+    return PngData(
+        image_path=image_path,
+        favorite=bool(flags & FLAG_FAVORITE),
+        checkpoint=fields[0],
+        loras=fields[1:1 + lora_count],
+        positive_prompt=positive_prompt,
+        negative_prompt=negative_prompt,
+        tags=fields[1 + lora_count:tags_end],
+        timestamp=timestamp,
+        raw_data=raw_data,
+        error=error,
+    )
@@ -6,8 +6,8 @@ from PIL import Image
 import json
 import os
 import re
-import lib.image_helpers as imagez
 import lib.list_helpers as listz
+import lib.png_chunks as pngchunks
 NODE_NAMES_SAMPLER = ["KSampler"]
 NODE_NAMES_MODEL = ["CheckpointLoader"]
 NODE_NAMES_CLIP = ["CLIPTextEncode", "CLIP"]
@@ -50,8 +50,8 @@ class PngParser:
         return tag.lower()
     
     
-    def __parse_automatic1111(self, im: Image, image_path):
-        text = im.info['parameters']
+    def __parse_automatic1111(self, info: dict, image_path):
+        text = info['parameters']
 
         def halve(text, separator):
             tokens = text.split(separator, 1)
@@ -82,8 +82,8 @@ class PngParser:
 
 
     
-    def __parse_comfyui(self, im: Image, image_path):
-        workflow = im.info['workflow']
+    def __parse_comfyui(self, info: dict, image_path):
+        workflow = info['workflow']
 
         data = json.loads(workflow)
 
@@ -182,18 +182,25 @@ class PngParser:
         return result
 
 
+    def __read_info(self, image_path):
+        try:
+            return pngchunks.read_text_chunks(image_path)
+        except pngchunks.PngChunkError:
+            # Not really a PNG (e.g. a renamed JPEG), so let PIL figure it out
+            with Image.open(image_path) as im:
+                return im.info
+
+    # Reads only the PNG text chunks, so no pixel data is decoded.
+    # Thumbnails are generated separately, by the ThumbnailQueue.
     def parse(self, image_path: str) -> PngData:
         timestamp = os.path.getctime(image_path)
-        im = Image.open(image_path)
-        im.load()
+        info = self.__read_info(image_path)
 
-        raw_data = im.info
-        thumbnail_base64 = imagez.make_thumbnail_base64(im)
+        raw_data = info
 
         def default(error=""):
             return PngData(
                 image_path=image_path,
-                thumbnail_base64 = thumbnail_base64,
                 timestamp=timestamp,
                 raw_data=raw_data,
                 loras=[],
@@ -202,10 +209,10 @@ class PngParser:
             )
         result = None
         try:
-            if "workflow" in im.info:
-                result = self.__parse_comfyui(im, image_path)
-            if "parameters" in im.info:
-                result = self.__parse_automatic1111(im, image_path)
+            if "workflow" in info:
+                result = self.__parse_comfyui(info, image_path)
+            if "parameters" in info:
+                result = self.__parse_automatic1111(info, image_path)
 
             if result == None:
                 return default()
@@ -240,7 +247,6 @@ class PngParser:
                 negative_prompt=negative_prompt,
                 checkpoint=model_name,
                 loras=loras,
-                thumbnail_base64 = thumbnail_base64,
                 timestamp=timestamp,
                 raw_data=raw_data
             )
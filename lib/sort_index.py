@@ -0,0 +1,67 @@
+from bisect import bisect_left, bisect_right
+from collections.abc import Sequence
+from typing import Callable, List
+
+# Removing more records than this at once rebuilds the list in one pass instead of deleting each one
+MAX_SINGLE_REMOVALS = 16
+
+class SortIndex:
+    """
+    Records kept in ascending order of key(record), which must be unique per record. New records are
+    placed by binary search and spliced in with one pass over the list, so it never needs sorting again.
+    """
+    def __init__(self, key: Callable):
+        self.key = key
+        self.records = []
+
+    def add_many(self, records: List):
+        key = self.key
+        if len(records) == 1:
+            record = records[0]
+            self.records.insert(bisect_right(self.records, key(record), key=key), record)
+            return
+        merged = []
+        start = 0
+        for record in sorted(records, key=key):
+            position = bisect_right(self.records, key(record), start, key=key)
+            merged.extend(self.records[start:position])
+            merged.append(record)
+            start = position
+        merged.extend(self.records[start:])
+        self.records = merged
+
+    def remove_many(self, records: List):
+        if len(records) > MAX_SINGLE_REMOVALS:
+            removed = set(id(record) for record in records)
+            self.records = [record for record in self.records if id(record) not in removed]
+            return
+        key = self.key
+        for record in records:
+            i = bisect_left(self.records, key(record), key=key)
+            if i < len(self.records) and self.records[i] is record:
+                del self.records[i]
+
+    def view(self, reverse=False) -> "SortView":
+        return SortView(self, reverse)
+
+
+class SortView(Sequence):
+    """A SortIndex as a read-only sequence, optionally reversed without copying it."""
+    def __init__(self, sort_index: SortIndex, reverse: bool):
+        self.sort_index = sort_index
+        self.reverse = reverse
+
+    def __len__(self):
+        return len(self.sort_index.records)
+
+    def __iter__(self):
+        return reversed(self.sort_index.records) if self.reverse else iter(self.sort_index.records)
+
+    def __getitem__(self, i):
+        records = self.sort_index.records
+        if not self.reverse:
+            return records[i]
+        if isinstance(i, slice):
+            start, stop, _ = i.indices(len(records))
+            return records[len(records) - stop:len(records) - start][::-1] if start < stop else []
+        return records[~i]
@@ -1,24 +1,163 @@
-from typing import List
+from array import array
+from bisect import bisect_left
+from typing import List, Tuple
 
+from lib.bitmaps import from_bitmap, to_bitmap
 from lib.tag_data import TagData
+from lib.tag_facets import TagFacets
+from lib.tag_search import TagSearchIndex
+
 class TagCache:
+    """
+    Inverted index from tags to images. Each image gets a dense integer id the first time it's
+    added, and each tag keeps a sorted array of those ids. Queries work on bitmaps built from
+    the arrays, so an AND/OR/NOT of two tags is one big-int operation that runs a machine word
+    at a time, and popcount gives its size.
+    """
     def __init__(self):
         self.__tag_index = {} 
+        self.__image_ids = {} # Path -> id
+        self.__image_paths = [] # Id -> path, or None once the image is removed. Ids aren't reused.
+        self.__all_bitmap = None
+        self.__sorted_tags = None
+        self.__search_index = None
+        self.__facets = None
+
+    def __get_or_create_image_id(self, filename: str) -> int:
+        image_id = self.__image_ids.get(filename)
+        if image_id is None:
+            image_id = len(self.__image_paths)
+            self.__image_paths.append(filename)
+            self.__image_ids[filename] = image_id
+            self.__all_bitmap = None
+        return image_id
 
     def add(self, tag: str, filename: str):
-        tag = tag.strip().lower()  
-        if tag not in self.__tag_index:
-            self.__tag_index[tag] = TagData(name=tag, files=[])  
-        self.__tag_index[tag].files.append(filename) # TODO Use a dictionary/set
+        self.add_all([tag], filename)
+
+    def add_all(self, tags: List[str], filename: str):
+        is_new_image = filename not in self.__image_ids
+        image_id = self.__get_or_create_image_id(filename)
+        added_tags = []
+        for tag in tags:
+            tag = tag.strip().lower()  
+            tag_data = self.__tag_index.get(tag)
+            if tag_data is None:
+                tag_data = self.__tag_index[tag] = TagData(name=tag)
+            image_ids = tag_data.image_ids
+            # Images are usually added one after another, so the new id almost always goes on the end
+            if len(image_ids) == 0 or image_ids[-1] < image_id:
+                image_ids.append(image_id)
+            else:
+                i = bisect_left(image_ids, image_id)
+                if i < len(image_ids) and image_ids[i] == image_id:
+                    continue
+                image_ids.insert(i, image_id)
+            tag_data.bitmap = None
+            added_tags.append(tag)
+        self.__sorted_tags = None
+        self.__search_index = None
+        if self.__facets is not None and (added_tags or is_new_image):
+            self.__facets.add(image_id, added_tags)
+
+    def remove(self, tag: str, filename: str):
+        tag = tag.strip().lower()
+        tag_data = self.__tag_index.get(tag)
+        image_id = self.__image_ids.get(filename)
+        if tag_data is None or image_id is None:
+            return
+        i = bisect_left(tag_data.image_ids, image_id)
+        if i == len(tag_data.image_ids) or tag_data.image_ids[i] != image_id:
+            return
+        del tag_data.image_ids[i]
+        tag_data.bitmap = None
+        self.__sorted_tags = None
+        self.__search_index = None
+        if self.__facets is not None:
+            self.__facets.remove(image_id, [tag])
+        if len(tag_data.image_ids) == 0:
+            del self.__tag_index[tag]
+
+    def remove_image(self, filename: str):
+        # Call after removing its tags. The id is retired, so its bit stays clear in every bitmap.
+        image_id = self.__image_ids.pop(filename, None)
+        if image_id is not None:
+            self.__image_paths[image_id] = None
+            self.__all_bitmap = None
+            if self.__facets is not None:
+                self.__facets.remove_image(image_id)
+
+    def restore(self, image_paths: List[str], tags: List[TagData]):
+        """Replaces the cache with a snapshot's, where each image's id is its position in image_paths."""
+        self.__tag_index = {tag_data.name: tag_data for tag_data in tags}
+        self.__image_paths = list(image_paths)
+        self.__image_ids = {image_path: image_id for image_id, image_path in enumerate(self.__image_paths)}
+        self.__all_bitmap = None
+        self.__sorted_tags = None
+        self.__search_index = None
+        self.__facets = None
 
-    def get(self, tag: str) -> str:
+    def export(self) -> Tuple[List[str], List[TagData]]:
+        """
+        The cache's images and tags, for a snapshot to restore(). Ids are renumbered without the gaps
+        left by removed images, so they're positions in the returned paths.
+        """
+        image_paths = [image_path for image_path in self.__image_paths if image_path is not None]
+        if len(image_paths) == len(self.__image_paths):
+            return image_paths, [TagData(tag_data.name, array("I", tag_data.image_ids)) for tag_data in self.__tag_index.values()]
+        new_ids = array("I", [0]) * len(self.__image_paths)
+        for new_id, image_path in enumerate(image_paths):
+            new_ids[self.__image_ids[image_path]] = new_id
+        return image_paths, [TagData(tag_data.name, array("I", map(new_ids.__getitem__, tag_data.image_ids))) for tag_data in self.__tag_index.values()]
+
+    def get(self, tag: str) -> TagData:
         tag = tag.strip().lower()  
-        return self.__tag_index.get(tag, [])  
+        return self.__tag_index.get(tag, None)  
+
+    def get_bitmap(self, tag: str) -> int:
+        tag_data = self.get(tag)
+        if tag_data is None:
+            return 0
+        if tag_data.bitmap is not None:
+            return tag_data.bitmap
+        bitmap = to_bitmap(tag_data.image_ids)
+        # A bitmap spans every id up to the tag's last image, so a rare tag's would be far bigger than its
+        # id array. Only tags whose bitmap is no bigger than their array keep it; the rest rebuild it per query.
+        if (bitmap.bit_length() + 7) >> 3 <= tag_data.image_ids.itemsize * len(tag_data.image_ids):
+            tag_data.bitmap = bitmap
+        return bitmap
+
+    def get_all_bitmap(self) -> int:
+        """Every image currently in the cache, for NOT queries."""
+        if self.__all_bitmap is None:
+            self.__all_bitmap = to_bitmap([image_id for image_id, path in enumerate(self.__image_paths) if path is not None])
+        return self.__all_bitmap
+
+    def get_paths(self, tag_or_bitmap) -> List[str]:
+        """The paths of a tag's images, or of the images in a bitmap, in id order."""
+        if isinstance(tag_or_bitmap, int):
+            image_ids = from_bitmap(tag_or_bitmap)
+        else:
+            tag_data = self.get(tag_or_bitmap)
+            image_ids = tag_data.image_ids if tag_data else []
+        return [self.__image_paths[image_id] for image_id in image_ids]
     
     def keys(self) -> List[str]:
         return list(self.__tag_index.keys())
     
+    def get_search_index(self) -> TagSearchIndex:
+        # Rebuilt on the first search after the tags change
+        if self.__search_index is None:
+            self.__search_index = TagSearchIndex(self.get_all())
+        return self.__search_index
+
+    def get_facets(self) -> TagFacets:
+        # Created on first use, and then kept up to date as images are added and removed
+        if self.__facets is None:
+            self.__facets = TagFacets(self.get_all(), self.get_all_bitmap())
+        return self.__facets
+
     def get_all(self) -> List[TagData]:
-        tags = list(self.__tag_index.values())
-        tags.sort(key=lambda x: x.count(), reverse=True)
-        return tags
+        if self.__sorted_tags is None:
+            self.__sorted_tags = sorted(self.__tag_index.values(), key=lambda x: x.count(), reverse=True)
+        return list(self.__sorted_tags)
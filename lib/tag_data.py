@@ -1,8 +1,10 @@
+from array import array
 from dataclasses import dataclass, field
 
 @dataclass
 class TagData:
     name: str = ""
-    files: list[str] = None
+    image_ids: array = field(default_factory=lambda: array("I")) # Sorted TagCache image ids
+    bitmap: int = None # Cached by TagCache.get_bitmap for common tags, and dropped when image_ids changes
     def count(self) -> int:
-        return len(self.files)
\ No newline at end of file
+        return len(self.image_ids)
@@ -0,0 +1,161 @@
+from array import array
+from collections import Counter
+import itertools
+import threading
+from typing import Dict, List
+
+from lib.bitmaps import from_bitmap, to_bitmap
+from lib.tag_data import TagData
+
+# Tags on at least 1/DENSE_TAG_DIVISOR of the images are counted with bitmaps, the rest per image
+DENSE_TAG_DIVISOR = 128
+# How many of the latest selections keep their rare tag counts, so going back to one is nearly free
+RECENT_SELECTIONS = 8
+
+class TagFacets:
+    """
+    Counts how many images of a selection have each tag. Common tags are counted with a bitmap AND and
+    popcount each. The long tail of rare tags would need thousands of those per query, so their postings
+    are also kept transposed, per image. Their counts start from whichever known selection differs from
+    the new one by the fewest images: no images, every image, or one of the latest selections. Only the
+    images that differ are counted. From every image, those are the images outside the new selection.
+
+    The tags are copied when it's created, and indexed by build() or the first count. After that the
+    TagCache passes on each change, which is queued and applied at the start of the next count.
+    """
+    def __init__(self, tags: List[TagData], all_bitmap: int):
+        self.__tags = [(tag.name, array("I", tag.image_ids)) for tag in tags]
+        self.__all_bitmap = all_bitmap
+        self.__changes = [] # (image_id, tag names, whether they were added), or (image_id, None, False) for a removed image
+        self.__changes_lock = threading.Lock() # Separate, so queueing a change doesn't wait for a build or count
+        self.__lock = threading.Lock()
+
+    def __build(self):
+        if self.__tags is None:
+            return
+        id_count = self.__all_bitmap.bit_length()
+        self.__dense = {name: to_bitmap(image_ids) for name, image_ids in self.__tags if len(image_ids) * DENSE_TAG_DIVISOR >= id_count}
+        sparse = [(name, image_ids) for name, image_ids in self.__tags if len(image_ids) * DENSE_TAG_DIVISOR < id_count]
+
+        # Image id -> the numbers of its rare tags, as tuples that share the same int objects
+        tag_numbers = [[] for _ in range(id_count)]
+        for number, (_, image_ids) in enumerate(sparse):
+            for numbers in map(tag_numbers.__getitem__, image_ids):
+                numbers.append(number)
+        self.__tag_numbers = [tuple(numbers) for numbers in tag_numbers]
+
+        self.__sparse_names = [name for name, _ in sparse]
+        self.__sparse_numbers = {name: number for number, name in enumerate(self.__sparse_names)}
+        # (selection, rare tag counts indexed by tag number) for no images and every image, which are always
+        # kept, and for the latest selections, most recent last
+        self.__bases = [(0, [0] * len(sparse)), (self.__all_bitmap, [len(image_ids) for _, image_ids in sparse])]
+        self.__recent = []
+        self.__tags = None
+
+    def build(self):
+        """Indexes the tags ahead of the first count, e.g. on a background thread."""
+        with self.__lock:
+            self.__build()
+
+    def add(self, image_id: int, tags: List[str]):
+        """Tags that TagCache just gave an image, which is new to the collection unless it's been added before."""
+        with self.__changes_lock:
+            self.__changes.append((image_id, tags, True))
+
+    def remove(self, image_id: int, tags: List[str]):
+        with self.__changes_lock:
+            self.__changes.append((image_id, tags, False))
+
+    def remove_image(self, image_id: int):
+        with self.__changes_lock:
+            self.__changes.append((image_id, None, False))
+
+    def __apply_changes(self):
+        with self.__changes_lock:
+            changes, self.__changes = self.__changes, []
+        if not changes:
+            return
+        tag_numbers = self.__tag_numbers
+        old_numbers = {} # Image id -> its rare tag numbers before the changes, for the images whose numbers change
+        is_in_collection = {} # Image id -> whether it's in the collection after the changes
+        has_dense_tag = {} # Tag name -> {image id: whether it has the tag after the changes}
+        for image_id, names, is_added in changes:
+            if image_id >= len(tag_numbers):
+                tag_numbers.extend([()] * (image_id + 1 - len(tag_numbers)))
+            if names is None:
+                # Whatever rare tags it still had go with it. Its common tags' bits are masked out when counting.
+                is_in_collection[image_id] = False
+                old_numbers.setdefault(image_id, tag_numbers[image_id])
+                tag_numbers[image_id] = ()
+                continue
+            if is_added:
+                is_in_collection[image_id] = True
+            for name in names:
+                if name in self.__dense:
+                    has_dense_tag.setdefault(name, {})[image_id] = is_added
+                    continue
+                number = self.__sparse_numbers.get(name)
+                if number is None:
+                    if not is_added:
+                        continue
+                    number = self.__sparse_numbers[name] = len(self.__sparse_names)
+                    self.__sparse_names.append(name)
+                    for _, counts in self.__bases + self.__recent:
+                        counts.append(0)
+                numbers = tag_numbers[image_id]
+                if (number in numbers) == is_added:
+                    continue
+                old_numbers.setdefault(image_id, numbers)
+                tag_numbers[image_id] = numbers + (number,) if is_added else tuple(n for n in numbers if n != number)
+
+        for name, has_tag in has_dense_tag.items():
+            added = to_bitmap([image_id for image_id, is_added in has_tag.items() if is_added])
+            removed = to_bitmap([image_id for image_id, is_added in has_tag.items() if not is_added])
+            self.__dense[name] = (self.__dense[name] | added) & ~removed
+        added = to_bitmap([image_id for image_id, is_added in is_in_collection.items() if is_added])
+        removed = to_bitmap([image_id for image_id, is_added in is_in_collection.items() if not is_added])
+        # Each kept count covers the images in its selection, so it's corrected for the ones among them that
+        # changed. A removed image has no numbers left, so it counts for nothing in a selection that still has it.
+        totals = self.__bases[1][1]
+        self.__bases[1] = (self.__all_bitmap | added, totals)
+        changed = to_bitmap(list(old_numbers))
+        for selection, counts in self.__bases + self.__recent:
+            for image_id in from_bitmap(selection & changed):
+                for number in old_numbers[image_id]:
+                    counts[number] -= 1
+                for number in tag_numbers[image_id]:
+                    counts[number] += 1
+        self.__all_bitmap = (self.__all_bitmap | added) & ~removed
+        self.__bases[1] = (self.__all_bitmap, totals)
+
+    def __count_sparse(self, bitmap: int) -> Counter:
+        # Counter takes a list faster than it takes the chain itself
+        return Counter(list(itertools.chain.from_iterable(map(self.__tag_numbers.__getitem__, from_bitmap(bitmap)))))
+
+    def __get_sparse_counts(self, selection: int) -> List[int]:
+        base_selection, base_counts = min(self.__bases + self.__recent, key=lambda base: (base[0] ^ selection).bit_count())
+        if base_selection == selection:
+            return base_counts
+        counts = list(base_counts)
+        for number, count in self.__count_sparse(selection & ~base_selection).items():
+            counts[number] += count
+        for number, count in self.__count_sparse(base_selection & ~selection).items():
+            counts[number] -= count
+
+        self.__recent = [*self.__recent, (selection, counts)][-RECENT_SELECTIONS:]
+        return counts
+
+    def count(self, selection: int) -> Dict[str, int]:
+        """Returns {tag: image count} within a bitmap of TagCache image ids, for the tags it has at least once."""
+        with self.__lock:
+            self.__build()
+            self.__apply_changes()
+            selection &= self.__all_bitmap
+            sparse_counts = self.__get_sparse_counts(selection)
+            counts = {}
+            for name, bitmap in self.__dense.items():
+                count = (selection & bitmap).bit_count()
+                if count:
+                    counts[name] = count
+            counts.update((name, count) for name, count in zip(self.__sparse_names, sparse_counts) if count)
+            return counts
@@ -0,0 +1,59 @@
+from dataclasses import dataclass
+from typing import List, Set, Tuple
+
+from lib.tag_cache import TagCache
+
+@dataclass(frozen=True)
+class TagClause:
+    """One filter chip: images with any of tags, or with none of them if negated. Chips are ANDed together."""
+    tags: Tuple[str, ...]
+    negated: bool = False
+
+    def label(self) -> str:
+        return ("-" if self.negated else "") + " | ".join(self.tags)
+
+    def matches(self, image_tags: Set[str]) -> bool:
+        return any(tag in image_tags for tag in self.tags) != self.negated
+
+def parse_clause(text: str) -> TagClause:
+    """Parses typed filters like "1girl", "-lora:foo" or "model:a | model:b". Returns None if there's no tag in it."""
+    text = text.strip()
+    negated = text.startswith("-")
+    if negated:
+        text = text[1:]
+    tags = tuple(tag.strip().lower() for tag in text.split("|") if tag.strip())
+    if not tags:
+        return None
+    return TagClause(tags, negated)
+
+def _clause_size(tag_cache: TagCache, clause: TagClause) -> int:
+    # An upper bound for ORs, which is all the ordering needs
+    return sum(tag_data.count() for tag_data in map(tag_cache.get, clause.tags) if tag_data)
+
+def _clause_bitmap(tag_cache: TagCache, clause: TagClause) -> int:
+    bitmap = 0
+    for tag in clause.tags:
+        bitmap |= tag_cache.get_bitmap(tag)
+    return bitmap
+
+def evaluate(tag_cache: TagCache, clauses: List[TagClause]) -> int:
+    """Returns the bitmap of images that match every clause."""
+    # Smallest first, so the running result shrinks as fast as possible and an empty one stops early
+    included = sorted((clause for clause in clauses if not clause.negated), key=lambda clause: _clause_size(tag_cache, clause))
+    result = None
+    for clause in included:
+        bitmap = _clause_bitmap(tag_cache, clause)
+        result = bitmap if result is None else result & bitmap
+        if not result:
+            return 0
+    if result is None:
+        result = tag_cache.get_all_bitmap()
+    for clause in clauses:
+        if clause.negated:
+            result &= ~_clause_bitmap(tag_cache, clause)
+    return result
+
+def matches(clauses: List[TagClause], image_tags: List[str]) -> bool:
+    """Whether a single image's tags match every clause, without touching the index."""
+    image_tags = set(tag.strip().lower() for tag in image_tags)
+    return all(clause.matches(image_tags) for clause in clauses)
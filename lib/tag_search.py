@@ -0,0 +1,59 @@
+from array import array
+from typing import List
+
+from lib.tag_data import TagData
+
+TAG_KIND_MODEL = "model"
+TAG_KIND_LORA = "lora"
+TAG_KIND_TAG = "tag"
+
+def tag_kind(name: str) -> str:
+    if name.startswith("model:"):
+        return TAG_KIND_MODEL
+    if name.startswith("lora:"):
+        return TAG_KIND_LORA
+    return TAG_KIND_TAG
+
+def _trigrams(text: str):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+class TagSearchIndex:
+    """
+    Finds tags by substring, most used first. Tags are numbered by rank, so every posting list
+    is already in rank order and a search can stop after the first N hits. A search uses the
+    postings of the query's rarest trigram, then checks each candidate. Substrings under three
+    characters check every tag in rank order instead.
+    """
+    def __init__(self, tags: List[TagData]):
+        self.__tags = tags # Most used first, as returned by TagCache.get_all()
+        self.__kinds = [tag_kind(tag.name) for tag in tags]
+        self.__trigrams = {} # Trigram -> ranks of the tags that contain it
+        trigrams = self.__trigrams
+        for rank, tag in enumerate(tags):
+            for trigram in _trigrams(tag.name):
+                try:
+                    trigrams[trigram].append(rank)
+                except KeyError:
+                    trigrams[trigram] = array("I", (rank,))
+
+    def __collect(self, ranks, text, kind, limit) -> List[TagData]:
+        results = []
+        for rank in ranks:
+            if (kind is None or self.__kinds[rank] == kind) and text in self.__tags[rank].name:
+                results.append(self.__tags[rank])
+                if len(results) >= limit:
+                    break
+        return results
+
+    def search(self, text: str, limit: int, kind: str = None) -> List[TagData]:
+        """The limit most used tags that contain text, optionally only of one kind."""
+        text = text.strip().lower()
+        if len(text) < 3:
+            # Too short for trigrams. A substring that short is in most tags, so walking them in rank order
+            # reaches limit hits quickly.
+            return self.__collect(range(len(self.__tags)), text, kind, limit)
+        postings = [self.__trigrams.get(trigram) for trigram in _trigrams(text)]
+        if any(p is None for p in postings):
+            return []
+        # Every match contains the rarest trigram, and ranks are in order, so the walk stops at limit hits
+        return self.__collect(min(postings, key=len), text, kind, limit)
@@ -0,0 +1,101 @@
+import heapq
+import itertools
+import os
+import threading
+
+PRIORITY_CURRENT_PAGE = 0
+PRIORITY_NEXT_PAGE = 1
+PRIORITY_BACKGROUND = 2
+
+class ThumbnailQueue:
+    """
+    Generates thumbnails on background threads, most important images first.
+    Images are added at background priority as soon as they're indexed, and the gallery
+    bumps whatever it is currently showing with prioritize().
+    """
+    def __init__(self, func_make_thumbnail, func_on_thumbnail, max_workers=None):
+        self.func_make_thumbnail = func_make_thumbnail # image_path -> {tier: thumbnail}
+        self.func_on_thumbnail = func_on_thumbnail # (image_path, {tier: thumbnail}) -> None
+        self.max_workers = max_workers or os.cpu_count() or 1
+
+        self.__condition = threading.Condition()
+        self.__heap = [] # (priority, sequence, image_path). Stale entries are skipped when popped.
+        self.__priorities = {} # image_path -> best queued priority
+        self.__sequence = itertools.count()
+        self.__generation = 0 # Bumped by clear(), so in-flight results from an old collection are dropped
+        self.__stopped = False
+        self.__threads = []
+
+    def __start_workers(self):
+        self.__threads = [t for t in self.__threads if t.is_alive()]
+        while len(self.__threads) < self.max_workers:
+            thread = threading.Thread(target=self.__work, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def __push(self, image_path, priority):
+        current = self.__priorities.get(image_path)
+        if current is not None and current <= priority:
+            return
+        self.__priorities[image_path] = priority
+        heapq.heappush(self.__heap, (priority, next(self.__sequence), image_path))
+
+    def add(self, image_path, priority=PRIORITY_BACKGROUND):
+        self.add_all([image_path], priority)
+
+    def add_all(self, image_paths, priority=PRIORITY_BACKGROUND):
+        with self.__condition:
+            if self.__stopped:
+                return
+            for image_path in image_paths:
+                self.__push(image_path, priority)
+            self.__start_workers()
+            self.__condition.notify_all()
+
+    def prioritize(self, image_paths, priority):
+        # Only images that are still waiting get bumped; finished ones are left alone
+        with self.__condition:
+            for image_path in image_paths:
+                if image_path in self.__priorities:
+                    self.__push(image_path, priority)
+            self.__condition.notify_all()
+
+    def __pop(self):
+        with self.__condition:
+            while True:
+                if self.__stopped:
+                    return None
+                while self.__heap:
+                    priority, _, image_path = heapq.heappop(self.__heap)
+                    if self.__priorities.get(image_path) == priority:
+                        del self.__priorities[image_path]
+                        return (image_path, self.__generation)
+                self.__condition.wait()
+
+    def __work(self):
+        while True:
+            item = self.__pop()
+            if item is None:
+                return
+            image_path, generation = item
+            try:
+                thumbnail = self.func_make_thumbnail(image_path)
+            except Exception as e:
+                print(f"ERROR: Could not make thumbnail for {image_path}: {e}")
+                continue
+            if generation != self.__generation:
+                continue
+            self.func_on_thumbnail(image_path, thumbnail)
+
+    def clear(self):
+        with self.__condition:
+            self.__heap.clear()
+            self.__priorities.clear()
+            self.__generation += 1
+
+    def stop(self):
+        with self.__condition:
+            self.__stopped = True
+            self.__heap.clear()
+            self.__priorities.clear()
+            self.__condition.notify_all()
@@ -0,0 +1,138 @@
+from collections import OrderedDict
+import threading
+from typing import Dict, List
+
+class ViewerCache:
+    """
+    The image viewer's recently shown and upcoming images, already downscaled to the viewer's size and
+    encoded for sending, in an LRU bounded by their total size. A background thread loads the neighbours
+    of the image on screen, so stepping back and forth doesn't go back to the disk.
+    """
+    def __init__(self, func_load_image, max_bytes):
+        self.func_load_image = func_load_image # image_path -> bytes
+        self.max_bytes = max_bytes
+
+        self.__condition = threading.Condition()
+        self.__entries = OrderedDict() # image_path -> bytes, least recently used first
+        self.__size = 0
+        self.__loading = {} # image_path -> Event, for loads in flight, so nothing is read twice
+        self.__prefetch_paths = [] # Replaced by each prefetch(), since only the latest neighbours matter
+        self.__prefetching = False # Between taking a path off __prefetch_paths and loading it
+        self.__generation = 0 # Bumped by clear(), so loads for a closed collection aren't kept
+        self.__stopped = False
+        self.__thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.reads = 0 # Images loaded from disk, by prefetching or on a miss
+
+    def lookup(self, image_path) -> bytes:
+        """The cached image, or None. Counts a hit or a miss."""
+        with self.__condition:
+            data = self.__entries.get(image_path)
+            if data is None:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(image_path)
+            self.hits += 1
+            return data
+
+    def load(self, image_path) -> bytes:
+        """The image, from the cache, from a prefetch that is already reading it, or from disk."""
+        while True:
+            with self.__condition:
+                data = self.__entries.get(image_path)
+                if data is not None:
+                    self.__entries.move_to_end(image_path)
+                    return data
+                event = self.__loading.get(image_path)
+                if event is None:
+                    event = self.__loading[image_path] = threading.Event()
+                    generation = self.__generation
+                    break
+            event.wait()
+        try:
+            data = self.func_load_image(image_path)
+            with self.__condition:
+                self.reads += 1
+                if generation == self.__generation:
+                    self.__put(image_path, data)
+            return data
+        finally:
+            with self.__condition:
+                if self.__loading.get(image_path) is event:
+                    del self.__loading[image_path]
+                self.__condition.notify_all()
+            event.set()
+
+    def __put(self, image_path, data):
+        if len(data) > self.max_bytes:
+            return
+        old = self.__entries.pop(image_path, None)
+        if old is not None:
+            self.__size -= len(old)
+        self.__entries[image_path] = data
+        self.__size += len(data)
+        while self.__size > self.max_bytes:
+            _, evicted = self.__entries.popitem(last=False)
+            self.__size -= len(evicted)
+
+    def prefetch(self, image_paths: List[str]):
+        """Loads image_paths in the background, in order, instead of whatever was asked for before."""
+        with self.__condition:
+            if self.__stopped:
+                return
+            self.__prefetch_paths = [image_path for image_path in image_paths if image_path is not None]
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__prefetch_loop, daemon=True)
+                self.__thread.start()
+            self.__condition.notify_all()
+
+    def __prefetch_loop(self):
+        while True:
+            with self.__condition:
+                while not self.__prefetch_paths and not self.__stopped:
+                    self.__condition.wait()
+                if self.__stopped:
+                    return
+                image_path = self.__prefetch_paths.pop(0)
+                if image_path in self.__entries or image_path in self.__loading:
+                    self.__condition.notify_all()
+                    continue
+                self.__prefetching = True
+            try:
+                self.load(image_path)
+            except Exception as e:
+                print(f"ERROR: Could not prefetch {image_path}: {e}")
+            with self.__condition:
+                self.__prefetching = False
+                self.__condition.notify_all()
+
+    def wait_for_prefetch(self, timeout=None) -> bool:
+        """Blocks until every requested prefetch has finished. Returns False on timeout."""
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.__stopped or not (self.__prefetch_paths or self.__prefetching or self.__loading), timeout)
+
+    def stats(self) -> Dict[str, int]:
+        with self.__condition:
+            return {"hits": self.hits, "misses": self.misses, "reads": self.reads, "images": len(self.__entries), "bytes": self.__size}
+
+    def discard(self, image_paths: List[str]):
+        """Forgets images whose files changed or went away."""
+        with self.__condition:
+            for image_path in image_paths:
+                data = self.__entries.pop(image_path, None)
+                if data is not None:
+                    self.__size -= len(data)
+
+    def clear(self):
+        with self.__condition:
+            self.__entries.clear()
+            self.__size = 0
+            self.__prefetch_paths = []
+            self.__generation += 1
+
+    def stop(self):
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify_all()
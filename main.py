@@ -3,6 +3,7 @@ import base64
 from io import BytesIO
 import subprocess
 import threading
+import time
 from typing import List
 import pyperclip
 import flet as ft
@@ -11,40 +12,58 @@ import concurrent.futures
 from PIL import Image
 import json
 from dataclasses import asdict, field
-from functools import partial
-from controls.image_gallery import ImageGallery
+from functools import partial, wraps
+from controls.image_gallery import SNAPSHOT_ORDERS, SORT_KEYS, ImageGallery
 from controls.settings_view import SettingsView
 from controls.slideshow_button import SlideshowButton
+from controls.tag_browser import TagBrowser
+from lib.collection_snapshot import CollectionSnapshot, delete_snapshot, paused_gc, read_change_count, snapshot_filename, write_snapshot
 from lib.configurator import Configurations, ImageCollection
-from lib.database import DiskCacheEntry, Database
+from lib.database import DiskCacheEntry, Database, delete_database, split_shared_database
+from lib.folder_watcher import FolderWatcher
+from lib.ingest import INGEST_MODE_PROCESS, ProcessIngestEngine
+from lib.thumbnail_queue import PRIORITY_CURRENT_PAGE, PRIORITY_NEXT_PAGE, ThumbnailQueue
+from lib.viewer_cache import ViewerCache
 
 from lib.png_data import PngData
 from lib.png_parser import PngParser
-from lib.image_cache import ImageCache
+from lib.image_cache import ImageCache, ImageSummary
 from lib.tag_cache import TagCache
 import lib.file_helpers as filez
 import lib.image_helpers as imagez
+import lib.tag_query as tag_query
 from lib.tag_data import TagData
+from lib.tag_search import TAG_KIND_LORA, TAG_KIND_MODEL, TAG_KIND_TAG
 
 
-PARSED_IMAGE_BATCH_SIZE = 256
-NEW_IMAGE_BATCH_SIZE = 256
+# While a collection opens, the first page is shown once it's full or after this many seconds
+FIRST_PAGE_LATENCY = 0.25
+# After that, the gallery picks up the images streaming in at most this often, in seconds
+STREAM_REFRESH_INTERVAL = 1.0
+# Tag filter results shown per tab
+TAG_SEARCH_LIMIT = 500
 
 def create_executor():
     MAX_WORKERS = 8
     return concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
 executor = create_executor()
+ingest_engine = ProcessIngestEngine()
 application_quit_hooks = []
+application_exit_hooks = [] # Only run once the app itself is closing
 
 def stop_threads(should_create_new_executor):
     global executor
     print("Shutting down worker threads...")
     executor.shutdown(wait=True, cancel_futures=True)
+    ingest_engine.shutdown()
     for stop_func in application_quit_hooks:
         stop_func()
     if should_create_new_executor:
         executor = create_executor()
+    else:
+        for exit_func in application_exit_hooks:
+            exit_func()
 
 def main(page: ft.Page):
     cache_dir = ".cache"
@@ -53,12 +72,27 @@ def main(page: ft.Page):
     png_parser = PngParser()
 
     tag_cache = TagCache()
-    image_cache = ImageCache()
-    database = Database(cache_dir, "data.sqlite3")
-    database.try_create_database()
+    image_cache = ImageCache(lambda image_path: database.get(image_path))
 
     config = Configurations(cache_dir, "config.json")
 
+    # Older versions kept every collection in one shared database
+    if os.path.exists(os.path.join(cache_dir, "data.sqlite3")):
+        split_shared_database(cache_dir, "data.sqlite3", {
+            collection.directory_path: config.get_database_filename(collection) for collection in config.get_collections()
+        })
+    database = None # The open collection's database
+
+    # The loading and folder watcher threads change the caches and galleries while UI handlers read them.
+    # Whatever touches them holds this lock. It's reentrant, since those functions call each other.
+    index_lock = threading.RLock()
+    def holding_index_lock(func):
+        @wraps(func)
+        def locked(*args, **kwargs):
+            with index_lock:
+                return func(*args, **kwargs)
+        return locked
+
     page.title = "Image Browser"
 
     def show_toast(text: str):
@@ -79,17 +113,38 @@ def main(page: ft.Page):
                 next_popup(1, e)
             if e.key == "Arrow Left" or e.key == "A":
                 next_popup(-1, e)
+            if e.key == "G":
+                show_in_other_gallery(image_popup.data.image_path, e)
 
+    @holding_index_lock
     def next_popup(plus_or_minus_one, e):
         if e is not None:
             slideshow_button.reset_timer_if_running()
 
-        image_data = image_popup.data
-        for i, entry in enumerate(current_image_grid.images):
-            if entry.data.image_path == image_data.image_path:
-                next_index = (i+plus_or_minus_one) % len(current_image_grid.images)
-                create_image_popup(current_image_grid.images[next_index].data.image_path, None)
-                return
+        image_path = current_image_grid.get_neighbor(image_popup.data.image_path, plus_or_minus_one)
+        if image_path is not None:
+            create_image_popup(image_path, None)
+
+    @holding_index_lock
+    def jump_to_index(e):
+        # The popup's position field counts from 1
+        try:
+            index = int(e.control.value) - 1
+        except ValueError:
+            return
+        image_path = current_image_grid.get_image_path(index)
+        if image_path is not None:
+            create_image_popup(image_path, None)
+
+    @holding_index_lock
+    def show_in_other_gallery(image_path, e):
+        # Switches between Images and Favorites, keeping the popup on the same image
+        other_gallery = image_gallery_favorites if current_image_grid is image_gallery else image_gallery
+        if not other_gallery.show_image(image_path):
+            show_toast("That image isn't in the other gallery")
+            return
+        show_gallery_view(other_gallery)
+        create_image_popup(image_path, None)
     slideshow_button = SlideshowButton(next_popup, config)
     application_quit_hooks.append(slideshow_button.stop_slideshow)
         
@@ -100,185 +155,536 @@ def main(page: ft.Page):
         )
         database.upsert(cache_entry)
 
-    def load_images_from_directory(dir_path, force_refresh):
-        def process_image(filename):
-            image_path = os.path.join(dir_path, filename)
-
-            # Check the disk cache, otherwise parse it
-            png_data = database.get(image_path)
-            should_update_disk_cache = False
-            if png_data is None or force_refresh:
-                print(".", end="")
-                favorite = False
-                if png_data:
-                    favorite = png_data.favorite
-                png_data = png_parser.parse(image_path)
-                png_data.favorite = favorite
-                should_update_disk_cache = True
-            
+    @holding_index_lock
+    def on_thumbnails(image_path, thumbnails):
+        png_data = image_cache.get_summary(image_path)
+        collection_database = database
+        if png_data is None or collection_database is None:
+            return # The collection was closed in the meantime
+        collection_database.upsert_thumbnails(image_path, thumbnails, thumbnail_format)
+        thumbnails_base64 = {tier: imagez.to_base64(thumbnail) for tier, thumbnail in thumbnails.items()}
+        image_gallery.set_thumbnails(image_path, thumbnails_base64)
+        if png_data.favorite:
+            image_gallery_favorites.set_thumbnails(image_path, thumbnails_base64)
+
+    def get_thumbnails_base64(image_paths, tier):
+        collection_database = database
+        if collection_database is None:
+            return {} # The collection is closing
+        thumbnails = collection_database.get_thumbnails(image_paths, tier)
+        # Images without this tier yet get it made now. Those without any thumbnail are still
+        # waiting in thumbnail_queue, which only makes the eager tiers.
+        missing_paths = [
+            image_path for image_path in image_paths
+            if (thumbnails[image_path][0] != tier if image_path in thumbnails else tier not in imagez.EAGER_THUMBNAIL_TIERS)
+        ]
+        if missing_paths:
+            tier_queue.add_all(missing_paths, PRIORITY_CURRENT_PAGE)
+        return {image_path: (tier, imagez.to_base64(thumbnail)) for image_path, (tier, thumbnail) in thumbnails.items()}
+
+    thumbnail_format = config.get_config("thumbnail_format").upper()
+    thumbnail_queue = ThumbnailQueue(partial(imagez.load_thumbnails, format=thumbnail_format), on_thumbnails)
+    # Makes every tier for images that are shown at one they don't have yet, all from one decode
+    tier_queue = ThumbnailQueue(partial(imagez.load_thumbnails, tiers=imagez.THUMBNAIL_TIERS, format=thumbnail_format), on_thumbnails, max_workers=2)
+
+    def load_viewer_image(image_path):
+        # Sized to the popup's image area, left of its 384px sidebar
+        if page.width and page.height:
+            max_size = (max(int(page.width) - 384, 256), max(int(page.height), 256))
+        else:
+            max_size = (2048, 2048)
+        return imagez.load_display_image(image_path, max_size)
+
+    viewer_cache = ViewerCache(load_viewer_image, config.get_config("viewer_cache_mb") * 1024 * 1024)
+    def close_database():
+        nonlocal database
+        if database is not None:
+            database.close()
+            database = None
+
+    application_exit_hooks.append(lambda: stop_folder_watcher())
+    application_exit_hooks.append(lambda: save_snapshot())
+    application_exit_hooks.append(thumbnail_queue.stop)
+    application_exit_hooks.append(tier_queue.stop)
+    application_exit_hooks.append(close_database)
+    application_exit_hooks.append(viewer_cache.stop)
+
+    def prioritize_thumbnails(current_page_paths, next_page_paths):
+        thumbnail_queue.prioritize(next_page_paths, PRIORITY_NEXT_PAGE)
+        thumbnail_queue.prioritize(current_page_paths, PRIORITY_CURRENT_PAGE)
+
+    @holding_index_lock
+    def index_png_data(png_data: PngData):
+        # Save to memory cache
+        image_cache.set(png_data.image_path, png_data)
+        tag_cache.add_all(png_data.tags, png_data.image_path)
+
+    def save_parsed_png_data(png_data: PngData, fingerprint):
+        file_size, file_mtime = fingerprint
+        database.upsert(DiskCacheEntry(
+            image_path=png_data.image_path,
+            png_data=png_data,
+            file_size=file_size,
+            file_mtime=file_mtime
+        ))
+
+    def parse_with_threads(image_paths):
+        futures = [executor.submit(png_parser.parse, image_path) for image_path in image_paths]
+        for future in concurrent.futures.as_completed(futures):
+            yield [future.result()]
 
-            # Save to memory cache                
-            image_cache.set(image_path, png_data)
-            for tag in png_data.tags:
-                tag_cache.add(tag, image_path)
+    def parse_with_processes(image_paths):
+        # The parsing happens in worker processes; cache and database writes stay here
+        return ingest_engine.parse(image_paths)
 
-            # Save to disk cache
-            if (should_update_disk_cache):
-                save_png_data(png_data)
+    def parse_images(image_paths):
+        if config.get_config("ingest_mode") == INGEST_MODE_PROCESS:
+            return parse_with_processes(image_paths)
+        return parse_with_threads(image_paths)
 
-            is_new_image = should_update_disk_cache
-            return (image_path, is_new_image)
-        
-        image_gallery.clear()
-        image_gallery_favorites.clear()
+    file_fingerprints = {} # The open collection's files, {image_path: (file_size, file_mtime)}
 
-        # Submit image processing tasks to the thread pool
-        futures = []
-
-        def get_all_files(dir_path):
-            all_files = []
-            for root, dirs, files in os.walk(dir_path):
-                for file in files:
-                    all_files.append(os.path.join(root, file))  # Get the full path
-            return list(set(all_files))
-        # file_list = os.listdir(dir_path)
-        file_list = get_all_files(dir_path)
-        print(f"Loading {len(file_list)} files")
-        for filename in file_list:
-            if filename.lower().endswith((".png")) and not os.path.basename(filename).startswith("."):
-                future = executor.submit(process_image, filename)
-                futures.append(future)
-        
-        # Wait for results and collect image paths
-        total = len(file_list)
-        count = 0
-        def process_completed_futures(futures):
-            nonlocal count
-            count += len(futures)
-            percent = round(100*count/total)
-            print(f"\nProcessing: {percent}%")
-            image_paths = [f.result()[0] for f in futures]
-            add_to_gallery(image_paths)
-            show_toast(f"Loading {percent}%")
-        batch_size = PARSED_IMAGE_BATCH_SIZE
-        batch_count = 0
-        completed_futures = []
-        for future in concurrent.futures.as_completed(futures):
-            if future.result()[1]:
-                batch_count += PARSED_IMAGE_BATCH_SIZE / NEW_IMAGE_BATCH_SIZE
-            else:
-                batch_count += 1
-            completed_futures.append(future)
-            if batch_count >= batch_size:
-                process_completed_futures(completed_futures)
-                completed_futures.clear()
-                batch_count = 0
-        if completed_futures:
-            process_completed_futures(completed_futures)
+    def get_file_size(image_path):
+        return file_fingerprints.get(image_path, (None, None))[0]
 
+    def load_images_from_directory(dir_path, force_refresh):
+        # A snapshot that's still current for the database is restored whole, with its sort orders, and
+        # nothing is decoded until it's needed. Otherwise the cached rows stream out of the database newest
+        # first, so the first page shown is already the right one. The directory scan runs alongside, and is
+        # checked against the images once they're all in: vanished images are dropped, and new or modified
+        # ones are parsed and merged in after that.
+        nonlocal folder_watcher
+        nonlocal loaded_directory
+        load_start = time.perf_counter()
+        collection_database = database
+        def is_closed():
+            # Another collection may be opened before this one finishes loading. Checked while holding
+            # index_lock, together with whatever the load changes next.
+            return database is not collection_database
+        collection_database.flush() # Make sure writes from a previous session are visible
+        files_future = executor.submit(filez.scan_images, dir_path)
+        thumbnail_paths = collection_database.get_thumbnail_paths(max(imagez.EAGER_THUMBNAIL_TIERS))
+
+        with index_lock:
+            image_gallery.clear()
+            image_gallery_favorites.clear()
+            file_fingerprints.clear()
+
+        streamed_paths = []
+        is_first_page_shown = False
+        last_refresh = load_start
+        def stream_to_gallery(image_paths, is_last=False):
+            # Shows the first page once it's full or FIRST_PAGE_LATENCY has passed, then refreshes at most every
+            # STREAM_REFRESH_INTERVAL, without moving the gallery off whatever page is on screen by then
+            nonlocal streamed_paths, is_first_page_shown, last_refresh
+            streamed_paths.extend(image_paths)
+            now = time.perf_counter()
+            if is_first_page_shown:
+                is_due = now - last_refresh >= STREAM_REFRESH_INTERVAL
+            else:
+                is_due = len(streamed_paths) >= image_gallery.images_per_page or now - load_start >= FIRST_PAGE_LATENCY
+            if not (is_due or is_last) or not streamed_paths:
+                return
+            add_to_gallery(streamed_paths, keep_page=is_first_page_shown)
+            if not is_first_page_shown:
+                print(f"First page shown after {1000 * (now - load_start):.0f}ms")
+            is_first_page_shown = True
+            last_refresh = now
+            streamed_paths = []
+
+        # A refresh skips the snapshot, in case it's what went wrong
+        snapshot_path = snapshot_filename(collection_database.database_path)
+        snapshot = None if force_refresh else CollectionSnapshot.open(snapshot_path, dir_path, collection_database.get_change_count())
+        if snapshot is not None:
+            with index_lock, paused_gc():
+                if is_closed():
+                    return
+                image_cache.restore(snapshot)
+                tag_cache.restore(snapshot.image_paths, snapshot.tags)
+                cached_fingerprints = snapshot.get_fingerprints()
+                file_fingerprints.update(cached_fingerprints)
+                image_gallery.restore(snapshot)
+                image_gallery_favorites.restore(snapshot, only_favorites=True)
+                image_gallery.update_on_first_page()
+                image_gallery_favorites.update_on_first_page()
+            page.update()
+            is_first_page_shown = True
+            print(f"First page shown after {1000 * (time.perf_counter() - load_start):.0f}ms, from the collection snapshot")
+        else:
+            cached_fingerprints = {}
+            for png_data, fingerprint in collection_database.stream_collection(dir_path):
+                image_path = png_data.image_path
+                cached_fingerprints[image_path] = fingerprint
+                with index_lock:
+                    if is_closed():
+                        return
+                    file_fingerprints[image_path] = fingerprint
+                    index_png_data(png_data)
+                    stream_to_gallery([image_path])
+            with index_lock:
+                if is_closed():
+                    return
+                stream_to_gallery([], is_last=True)
+
+        try:
+            files = files_future.result()
+        except concurrent.futures.CancelledError:
+            return # close_collection stopped the executor
+        print(f"Loaded {len(cached_fingerprints)} cached images in {time.perf_counter() - load_start:.2f}s, found {len(files)} files")
+
+        # Fingerprints from the last scan tell us which files are new or modified
+        vanished_paths = []
+        modified_paths = []
+        unfingerprinted = {}
+        for image_path, fingerprint in cached_fingerprints.items():
+            if image_path not in files:
+                vanished_paths.append(image_path)
+            elif fingerprint == (None, None):
+                # Cached before fingerprints existed. Trust it, unless this is an explicit refresh.
+                unfingerprinted[image_path] = files[image_path]
+                if force_refresh:
+                    modified_paths.append(image_path)
+            elif fingerprint != files[image_path]:
+                modified_paths.append(image_path)
+        uncached_paths = [*modified_paths, *(image_path for image_path in files if image_path not in cached_fingerprints)]
+
+        with index_lock:
+            if is_closed():
+                return
+            file_fingerprints.clear()
+            file_fingerprints.update(files)
+            favorites = remove_from_index([*vanished_paths, *modified_paths])
+            if vanished_paths:
+                collection_database.delete_many(vanished_paths)
+            if modified_paths:
+                collection_database.delete_thumbnails(modified_paths) # Modified files may have new pixels too
+                thumbnail_paths.difference_update(modified_paths)
+            if unfingerprinted:
+                collection_database.set_fingerprints(unfingerprinted)
+                if not force_refresh:
+                    add_to_gallery(list(unfingerprinted), keep_page=True) # Again, now with their file sizes
+            thumbnail_queue.add_all(image_path for image_path in cached_fingerprints if image_path in files and image_path not in thumbnail_paths)
+
+            # Everything cached is indexed, so the tags can be browsed while the rest is parsed
+            update_tag_facets()
+            show_tag_buttons(tag_cache.get_all())
+        nav_rail_dest_favorites.disabled = False
+        nav_rail_dest_tags.disabled = False
+        cached_count = len(cached_fingerprints) - len(vanished_paths) - len(modified_paths)
+        show_toast(f"Loaded {cached_count} images. Parsing {len(uncached_paths)} new or modified images...")
+        print(f"Parsing {len(uncached_paths)} new or modified images, removed {len(vanished_paths)}")
+
+        try:
+            for parsed_chunk in parse_images(uncached_paths):
+                with index_lock:
+                    if is_closed():
+                        return
+                    parsed_paths = []
+                    for png_data in parsed_chunk:
+                        print(".", end="")
+                        png_data.favorite = favorites.get(png_data.image_path, False)
+                        index_png_data(png_data)
+                        thumbnail_queue.add(png_data.image_path)
+                        save_parsed_png_data(png_data, files[png_data.image_path])
+                        if is_shown_in_gallery(png_data):
+                            parsed_paths.append(png_data.image_path)
+                    stream_to_gallery(parsed_paths)
+        except concurrent.futures.CancelledError:
+            return
 
         # Update tags when everything is loaded
-        tags = tag_cache.get_all()
-        show_tag_buttons(tags)
+        with index_lock:
+            if is_closed():
+                return
+            stream_to_gallery([], is_last=True)
+            tags = tag_cache.get_all()
+            update_tag_facets()
+            show_tag_buttons(tags)
+            if tag_filter_textfield.value:
+                filter_tag_buttons(tag_filter_textfield.value.lower())
+            # Built ahead of the first search and the first filter, which would otherwise wait for them
+            executor.submit(holding_index_lock(tag_cache.get_search_index))
+            executor.submit(build_tag_facets)
         # top_tags = list(filter(lambda x: not "model" in x.name and not "lora" in x.name, tags))
         # top_tags = top_tags[:500]
         # print(f"Printing top {len(top_tags)} tags:")
         # print(", ".join(map(lambda x: x.name, top_tags)))
-        nav_rail_dest_favorites.disabled = False
-        nav_rail_dest_tags.disabled = False
         show_toast(f"Finished loading!")
-        image_gallery.sort()
-        image_gallery_favorites.sort()
 
-    def add_to_gallery(image_paths):
+        # Before the watcher starts changing the caches
+        with index_lock:
+            if is_closed():
+                return
+            loaded_directory = dir_path
+        save_snapshot()
+
+        if config.get_config("watch_folders"):
+            poll_interval = config.get_config("folder_poll_seconds") if config.get_config("poll_folders") else None
+            with index_lock:
+                if is_closed():
+                    return
+                folder_watcher = FolderWatcher(dir_path, files, apply_folder_changes, poll_interval)
+                folder_watcher.start()
+
+    def is_shown_in_gallery(png_data: PngData):
+        # With tag filters selected, the gallery only shows images that match them
+        return tag_query.matches(get_selected_clauses(), png_data.tags)
+
+    @holding_index_lock
+    def remove_from_index(image_paths):
+        """Takes images out of the caches and galleries. Returns {image_path: favorite} for the ones that were in them."""
+        favorites = {}
         for image_path in image_paths:
-            png_data = image_cache.get(image_path)
+            png_data = image_cache.remove(image_path)
+            if png_data is None:
+                continue
+            favorites[image_path] = png_data.favorite
+            for tag in png_data.tags:
+                tag_cache.remove(tag, image_path)
+            tag_cache.remove_image(image_path)
+        if favorites:
+            image_gallery.delete_many(favorites.keys())
+            image_gallery_favorites.delete_many(favorites.keys())
+        return favorites
+
+    def apply_folder_changes(changed, deleted):
+        # Called by the FolderWatcher with each debounced batch of changes. The lock isn't held while
+        # the changed files are parsed, so the UI stays responsive.
+        with index_lock:
+            favorites = remove_from_index([*deleted, *changed])
+            for image_path in deleted:
+                file_fingerprints.pop(image_path, None)
+            file_fingerprints.update(changed)
+        viewer_cache.discard([*deleted, *changed])
+        if deleted:
+            database.delete_many(deleted)
+        if changed:
+            database.delete_thumbnails(list(changed))
+
+        for parsed_chunk in parse_images(list(changed)):
+            with index_lock:
+                for png_data in parsed_chunk:
+                    png_data.favorite = favorites.get(png_data.image_path, False)
+                    index_png_data(png_data)
+                    save_parsed_png_data(png_data, changed[png_data.image_path])
+                    thumbnail_queue.add(png_data.image_path)
+                    if is_shown_in_gallery(png_data):
+                        image_gallery.add_image(png_data, get_file_size(png_data.image_path))
+                    if png_data.favorite:
+                        image_gallery_favorites.add_image(png_data, get_file_size(png_data.image_path))
+
+        with index_lock:
+            image_gallery.update()
+            image_gallery_favorites.update()
+            update_tag_facets()
+            show_tag_buttons(tag_cache.get_all())
+            if tag_filter_textfield.value:
+                filter_tag_buttons(tag_filter_textfield.value.lower())
+        print(f"Folder changed: {len(changed)} new or modified, {len(deleted)} removed")
+        show_toast(f"Found {len(changed)} new or modified images, {len(deleted)} removed")
+
+    @holding_index_lock
+    def add_to_gallery(image_paths, keep_page=False):
+        for image_path in image_paths:
+            png_data = image_cache.get_summary(image_path)
             if png_data is None:
                 print(f"ERROR: png_data not found for {image_path}")
                 continue
-            image_gallery.add_image(png_data)
+            image_gallery.add_image(png_data, get_file_size(image_path))
             if png_data.favorite:
-                image_gallery_favorites.add_image(png_data)
-        image_gallery.update_on_first_page()
-        image_gallery_favorites.update_on_first_page()
+                image_gallery_favorites.add_image(png_data, get_file_size(image_path))
+        if keep_page:
+            # More images streaming in shouldn't move the gallery off the page on screen
+            image_gallery.update()
+            image_gallery_favorites.update()
+        else:
+            image_gallery.update_on_first_page()
+            image_gallery_favorites.update_on_first_page()
         print(f"Added {len(image_paths)} images to gallery.")
 
         page.update()
 
+    folder_watcher = None
+    loaded_directory = None # The open collection's folder, once it has finished loading
+    snapshot_lock = threading.Lock()
+
+    @holding_index_lock
+    def save_snapshot():
+        """
+        Saves a snapshot of the open collection unless the one on disk is current, i.e. was written at the
+        database's change count. The caches are copied here, and then sorted and written in the background.
+        """
+        collection_database = database
+        if loaded_directory is None or collection_database is None:
+            return # A collection that's still loading isn't all in the caches yet
+        directory = loaded_directory
+        collection_database.flush()
+        change_count = collection_database.get_change_count()
+        snapshot_path = snapshot_filename(collection_database.database_path)
+        if read_change_count(snapshot_path) == change_count:
+            return
+        image_paths, tags = tag_cache.export()
+        images = []
+        for image_path in image_paths:
+            summary = image_cache.get_summary(image_path)
+            file_size, file_mtime = file_fingerprints.get(image_path, (None, None))
+            images.append(ImageSummary(image_path, summary.timestamp or 0, summary.favorite, summary.checkpoint or "", summary.tag_count, file_size, file_mtime))
+        sort_keys = {name: SORT_KEYS[name] for name in SNAPSHOT_ORDERS}
+
+        def write():
+            start = time.perf_counter()
+            with snapshot_lock:
+                if not os.path.exists(collection_database.database_path):
+                    return # The collection was deleted in the meantime
+                try:
+                    write_snapshot(snapshot_path, directory, change_count, images, tags, sort_keys)
+                except (OSError, ValueError) as e:
+                    print(f"ERROR: Could not save the collection snapshot: {e}")
+                    return
+            print(f"Saved a snapshot of {len(images)} images in {time.perf_counter() - start:.2f}s")
+        # Not a daemon, so a snapshot saved on exit is finished first
+        threading.Thread(target=write).start()
+
+    def stop_folder_watcher():
+        nonlocal folder_watcher
+        if folder_watcher is not None:
+            folder_watcher.stop()
+            folder_watcher = None
+
     def close_collection():
         nonlocal tag_cache
         nonlocal image_cache
-        image_gallery.clear()
-        image_gallery_favorites.clear()
-        tag_cache = TagCache()
-        image_cache = ImageCache()
+        nonlocal loaded_directory
+        nonlocal database
+        stop_folder_watcher() # Before the caches go away, since it writes to them
+        save_snapshot()
+        # Not held while the threads below are stopped, since they may be waiting for it. A load that's still
+        # running sees that database changed, and stops.
+        with index_lock:
+            closing_database, database = database, None
+            loaded_directory = None
+            image_gallery.clear()
+            image_gallery_favorites.clear()
+            tag_cache = TagCache()
+            image_cache = ImageCache(lambda image_path: database.get(image_path))
+        stop_folder_watcher() # In case the load finished and started one in the meantime
+        thumbnail_queue.clear()
+        tier_queue.clear()
+        viewer_cache.clear()
         nav_rail_dest_images.disabled = True
         nav_rail_dest_favorites.disabled = True
         nav_rail_dest_tags.disabled = True
         clear_filter(None)
         clear_selected_tags(None)
         stop_threads(True) # Stop all background threads (e.g., gallery loading and slideshow timer)
+        if closing_database is not None:
+            closing_database.close()
 
     def go_to_gallery_view():
-        rail.selected_index = 1
+        show_gallery_view(image_gallery)
+
+    def show_gallery_view(gallery):
+        index = subviews.index(gallery.view)
+        rail.selected_index = index
         rail.update()
-        load_subview(1)
+        load_subview(index)
 
+    @holding_index_lock
     def reload_gallery_images(image_paths):
         image_gallery.clear()
         image_gallery_favorites.clear()
         add_to_gallery(image_paths)
         go_to_gallery_view()
 
-    selected_tag_buttons = []
-    selected_files = []
+    selected_tag_buttons = [] # Filter chips. Each one's data is a TagClause.
     def clear_selected_tags(e):
         selected_tag_buttons.clear()
-        selected_files.clear()
         filters_container.controls = selected_tag_buttons
         filters_container.update()
 
+    def get_selected_clauses():
+        return [button.data for button in selected_tag_buttons]
+
+    def build_tag_facets():
+        # Only copying the tags needs the lock. Changes made while the facets are built are applied on their first count.
+        with index_lock:
+            facets = tag_cache.get_facets()
+        facets.build()
+
+    tag_facet_counts = None # {tag: image count} within the filtered images, or None when nothing is filtered
+    @holding_index_lock
+    def update_tag_facets(matching_images: int = None):
+        nonlocal tag_facet_counts
+        clauses = get_selected_clauses()
+        if not clauses:
+            tag_facet_counts = None
+            return
+        if matching_images is None:
+            matching_images = tag_query.evaluate(tag_cache, clauses)
+        start = time.perf_counter()
+        tag_facet_counts = tag_cache.get_facets().count(matching_images)
+        print(f"Counted {len(tag_facet_counts)} tags within the filters in {1000 * (time.perf_counter() - start):.1f}ms")
+
+    @holding_index_lock
+    def apply_tag_filters():
+        prompt_search_textfield.value = ""
+        filters_container.controls = selected_tag_buttons
+        filters_container.update()
+        if len(selected_tag_buttons) == 0:
+            update_tag_facets()
+            filter_tag_buttons(tag_filter_textfield.value)
+            reload_gallery_images(image_cache.get_paths())
+            return
+        start = time.perf_counter()
+        matching_images = tag_query.evaluate(tag_cache, get_selected_clauses())
+        print(f"Tag query matched {matching_images.bit_count()} images in {1000 * (time.perf_counter() - start):.1f}ms")
+        update_tag_facets(matching_images)
+        filter_tag_buttons(tag_filter_textfield.value)
+        reload_gallery_images(tag_cache.get_paths(matching_images))
+
+    def add_tag_filter(clause: tag_query.TagClause):
+        if clause is None or clause in get_selected_clauses():
+            return
+        print(f"Adding tag filter {clause.label()}")
+        selected_tag_buttons.append(ft.ElevatedButton(clause.label(), icon=ft.icons.CLEAR_ROUNDED, on_click=deselect_tag, data=clause))
+        apply_tag_filters()
+
     def deselect_tag(e):
         nonlocal selected_tag_buttons
-        nonlocal selected_files
-        tag = e.control.data
-        # Remove the clicked button from the filters list
-        for button in selected_tag_buttons:
-            print(f"Current Buttons: {button.data.name}")
-            print(f"looking for: {tag.name}")
-        selected_tag_buttons = [button for button in selected_tag_buttons if button.data.name != tag.name]
-        
-        all_files = list(map(lambda image: image.image_path, image_cache.get_all()));
-        if len(selected_tag_buttons) == 0:
-            # Last filter removed.
-            clear_selected_tags(e)
-            reload_gallery_images(all_files)
-        else:
-            # Re-filter the master file list against each seleted tag 
-            selected_tags = [button.data for button in selected_tag_buttons]
-            for tag in selected_tags:
-                selected_files = [file for file in all_files if file in tag.files]
-            filters_container.controls = selected_tag_buttons
-            filters_container.update()
-            reload_gallery_images(selected_files)
+        clause = e.control.data
+        selected_tag_buttons = [button for button in selected_tag_buttons if button.data != clause]
+        apply_tag_filters()
 
     def select_tag(e):
-        nonlocal selected_files
         tag = e.control.data
         print(f"Clicked tag {tag.name}")
-        selected_tag_buttons.append(ft.ElevatedButton(f"{tag.name}", icon=ft.icons.CLEAR_ROUNDED, on_click=deselect_tag, data=tag))
-        print(f"Seleted tags: {len(selected_tag_buttons)}")
-        filters_container.controls = selected_tag_buttons
-        filters_container.update()
-
-        if len(selected_tag_buttons) == 1:
-            selected_files.extend(tag.files)
-        else:
-            selected_files = [file for file in selected_files if file in tag.files]
-        reload_gallery_images(selected_files)
+        add_tag_filter(tag_query.TagClause((tag.name,)))
+
+    def exclude_tag(e):
+        add_tag_filter(tag_query.TagClause((e.control.data.name,), negated=True))
+
+    @holding_index_lock
+    def search_prompts(e):
+        # Full-text search over prompts, checkpoints and LoRAs, ranked and paged by the database.
+        # The results replace the tag filters until the search is cleared.
+        query = (e.control.value or "").strip()
+        collection_database = database
+        if not query or collection_database is None:
+            apply_tag_filters()
+            return
+        collection_database.flush() # Images that were just parsed may still be queued
+        total_count = collection_database.count_prompt_matches(query)
+        print(f"Prompt search {query!r} matched {total_count} images")
+        def get_page(offset, limit):
+            png_datas = (image_cache.get_summary(image_path) for image_path in collection_database.search_prompts(query, limit, offset))
+            return [png_data for png_data in png_datas if png_data is not None]
+        image_gallery.show_page_source(total_count, get_page)
+        page.update()
 
     def open_collection(collection: ImageCollection, force_refresh, e):
+        nonlocal database
         close_collection()
+        database = Database(cache_dir, config.get_database_filename(collection))
         show_toast(f"Opening {collection.name}")
         nav_rail_dest_images.disabled = False
         nav_rail_dest_favorites.disabled = True
@@ -293,8 +699,10 @@ def main(page: ft.Page):
                     del collection_grid.controls[i]
         collection_grid.update()
         config.delete_collection(collection)
-        # TODO This would be avoided if I just used different Database files for each gallery
-        database.delete_by_prefix(collection.directory_path)
+        if collection.database_filename is not None:
+            delete_database(cache_dir, collection.database_filename)
+            with snapshot_lock:
+                delete_snapshot(os.path.join(cache_dir, snapshot_filename(collection.database_filename)))
 
     def create_collection_widget(collection: ImageCollection):
         print(collection)
@@ -435,6 +843,7 @@ def main(page: ft.Page):
         collection_grid.controls.append(create_collection_widget(collection))
 
 
+    @holding_index_lock
     def create_image_popup(image_path, e):
         nonlocal image_popup
         nonlocal favorites_button
@@ -472,23 +881,31 @@ def main(page: ft.Page):
                 ft.TextField(label="Error", read_only=True, multiline=True, value=image_data.error)
             ])
 
-                               
+
+        viewer_stack = ft.Stack([], expand=True, fit=ft.StackFit.EXPAND)
+        viewer_image = viewer_cache.lookup(image_path)
+        if viewer_image is not None:
+            viewer_stack.controls.append(ft.Image(
+                expand=True,
+                src_base64=imagez.to_base64(viewer_image),
+                fit=ft.ImageFit.CONTAIN,
+            ))
+        else:
+            # Shown while the image loads, if the thumbnail has been generated yet
+            thumbnails = database.get_thumbnails([image_path], max(imagez.THUMBNAIL_TIERS))
+            if image_path in thumbnails:
+                viewer_stack.controls.append(ft.Image(
+                    expand=True,
+                    src_base64=imagez.to_base64(thumbnails[image_path][1]), 
+                    fit=ft.ImageFit.CONTAIN,
+                ))
+            threading.Thread(target=show_viewer_image, args=(image_path, viewer_stack), daemon=True).start()
+
         content = ft.Row(
             alignment=ft.MainAxisAlignment.SPACE_EVENLY, 
             controls=[
                 ft.Container(
-                    content = ft.Stack([
-                        ft.Image(
-                            expand=True,
-                            src_base64=image_data.thumbnail_base64, 
-                            fit=ft.ImageFit.CONTAIN,
-                        ),
-                        ft.Image(
-                            expand=True,
-                            src=image_path, 
-                            fit=ft.ImageFit.CONTAIN,
-                        ),
-                    ], expand=True, fit=ft.StackFit.EXPAND),
+                    content = viewer_stack,
                     expand=True,
                     alignment=ft.alignment.center,
                 ),
@@ -521,6 +938,7 @@ def main(page: ft.Page):
             on_click=partial(reveal_file, image_data.image_path)
         )
 
+        @holding_index_lock
         def handle_delete(image_path, e):
             # for i, entry in enumerate(image_gallery.images):
             #     if entry.data.image_path == image_path:
@@ -528,6 +946,8 @@ def main(page: ft.Page):
             # for i, entry in enumerate(image_gallery_favorites.grid.controls):
             #     if entry.data.image_path == image_path:
             #         del image_gallery_favorites.grid.controls[i]
+            # The image after it moves up into its place
+            index = current_image_grid.index_of(image_path)
             image_gallery.delete(image_path)
             image_gallery_favorites.delete(image_path)
             
@@ -540,7 +960,11 @@ def main(page: ft.Page):
             image_gallery_favorites.grid.update()
             page.update()
             page.close(dialog)
-            next_popup(1, e)
+            next_image_path = current_image_grid.get_image_path(min(index, len(current_image_grid.images) - 1)) if index is not None else None
+            if next_image_path is None:
+                close_image_popup(e)
+            else:
+                create_image_popup(next_image_path, None)
 
         dialog = ft.AlertDialog(
             modal=True,
@@ -559,6 +983,16 @@ def main(page: ft.Page):
             on_click=lambda e: page.open(dialog)
         )
 
+        index = current_image_grid.index_of(image_path)
+        position_field = ft.TextField(
+            value=str(index + 1) if index is not None else "",
+            suffix_text=f"/ {len(current_image_grid.images)}",
+            tooltip="Jump to image #",
+            width=120,
+            dense=True,
+            on_submit=jump_to_index,
+        )
+
         image_popup = ft.Container(
             ft.Stack([
                 content,
@@ -584,6 +1018,12 @@ def main(page: ft.Page):
                             icon_color=ft.colors.BLUE_300,
                             on_click=partial(next_popup, 1),
                         ),
+                        position_field,
+                        ft.IconButton(
+                            icon=ft.icons.SWAP_HORIZ_ROUNDED,
+                            tooltip="Show in Images/Favorites (G)",
+                            on_click=partial(show_in_other_gallery, image_path),
+                        ),
                     ], alignment=ft.MainAxisAlignment.CENTER),
                 ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
             ], expand=True, data=image_path),
@@ -593,6 +1033,23 @@ def main(page: ft.Page):
 
         page_stack.controls = [main_view, image_popup]
         page.update()
+        # The images either side are loaded next, so stepping through them doesn't wait on the disk
+        viewer_cache.prefetch([current_image_grid.get_neighbor(image_path, step) for step in (1, -1, 2, -2)])
+
+    def show_viewer_image(image_path, viewer_stack):
+        try:
+            viewer_image = viewer_cache.load(image_path)
+        except Exception as e:
+            print(f"ERROR: Could not load {image_path}: {e}")
+            return
+        if image_popup is None or not image_popup.visible or image_popup.data.image_path != image_path:
+            return # Moved on to another image in the meantime
+        viewer_stack.controls.append(ft.Image(
+            expand=True,
+            src_base64=imagez.to_base64(viewer_image),
+            fit=ft.ImageFit.CONTAIN,
+        ))
+        viewer_stack.update()
 
     filters_container = ft.Row(
         vertical_alignment=ft.CrossAxisAlignment.START,
@@ -602,10 +1059,18 @@ def main(page: ft.Page):
         run_spacing=10,  # Spacing between rows
     )
     
-    image_gallery = ImageGallery(page, config, filters_container, create_image_popup)
-    image_gallery_favorites = ImageGallery(page, config, None, create_image_popup)
+    prompt_search_textfield = ft.TextField(
+        label="Search prompts...",
+        hint_text='e.g. red dress, "blue eyes", NEAR(red dress, 5), negative_prompt: blurry',
+        dense=True,
+        on_submit=search_prompts,
+    )
+
+    image_gallery = ImageGallery(page, config, ft.Column([prompt_search_textfield, filters_container]), create_image_popup, get_thumbnails_base64, prioritize_thumbnails, index_lock)
+    image_gallery_favorites = ImageGallery(page, config, None, create_image_popup, get_thumbnails_base64, prioritize_thumbnails, index_lock)
     current_image_grid = image_gallery
     
+    @holding_index_lock
     def set_images_per_page(x):
         x = int(x)
         image_gallery.images_per_page = x
@@ -617,28 +1082,21 @@ def main(page: ft.Page):
     # Creates the tags
     def show_tag_buttons(tags: List[TagData]):
         print("show_tag_buttons")
-        tag_controls["models"].controls.clear()
-        tag_controls["loras"].controls.clear()
-        tag_controls["tags"].controls.clear()
-        tag_buttons = [ft.ElevatedButton(f"{tag.name} ({tag.count()})", on_click=select_tag, data=tag) for tag in tags]
-        for tag_button in tag_buttons:
-            if tag_button.data.name.startswith("model:"):
-                tag_controls["models"].controls.append(tag_button)
-            elif tag_button.data.name.startswith("lora:"):
-                tag_controls["loras"].controls.append(tag_button)
-            else:
-                tag_controls["tags"].controls.append(tag_button)
-        tags_view.update()
+        tag_browser.show_tags(tags, tag_facet_counts)
     
-    # Hides all tags and shows only the necessary tags
+    # Shows only the most used tags that match the filter, in each tab
+    @holding_index_lock
     def filter_tag_buttons(filter: str): 
-        for tag_button in tag_controls["models"].controls:
-            tag_button.visible = filter in tag_button.data.name
-        for tag_button in tag_controls["loras"].controls:
-            tag_button.visible = filter in tag_button.data.name
-        for tag_button in tag_controls["tags"].controls:
-            tag_button.visible = filter in tag_button.data.name
-        tags_view.update()
+        filter = (filter or "").lower()
+        if not filter:
+            show_tag_buttons(tag_cache.get_all())
+            return
+        search_index = tag_cache.get_search_index()
+        show_tag_buttons([
+            *search_index.search(filter, TAG_SEARCH_LIMIT, TAG_KIND_MODEL),
+            *search_index.search(filter, TAG_SEARCH_LIMIT, TAG_KIND_LORA),
+            *search_index.search(filter, TAG_SEARCH_LIMIT, TAG_KIND_TAG),
+        ])
 
     update_tag_filter_timer = None
     async def update_tag_filter(e):
@@ -653,6 +1111,7 @@ def main(page: ft.Page):
         update_tag_filter_timer = threading.Timer(0.5, partial(update_tag_filter_internal))
         update_tag_filter_timer.start()
         
+    @holding_index_lock
     def clear_filter(e):
         nonlocal tag_filter_textfield
         tag_filter_textfield.value = ""
@@ -660,22 +1119,12 @@ def main(page: ft.Page):
         page.update()
 
 
-    def make_tags_button_row():
-        return ft.Row(
-            vertical_alignment=ft.CrossAxisAlignment.START,
-            controls=None,
-            wrap=True,
-            expand=True,
-            scroll=ft.ScrollMode.ALWAYS,
-            spacing=10,  # Spacing between buttons
-            run_spacing=10,  # Spacing between rows
-        )
-    tag_controls = {
-        "models": make_tags_button_row(),
-        "loras": make_tags_button_row(),
-        "tags": make_tags_button_row(),
-    }
-    tag_filter_textfield =  ft.TextField(label="Filter...", on_change=update_tag_filter)
+    tag_browser = TagBrowser(select_tag, exclude_tag)
+    def add_typed_tag_filter(e):
+        # Enter adds what was typed as a filter, e.g. "-lora:foo" or "model:a | model:b"
+        add_tag_filter(tag_query.parse_clause(e.control.value or ""))
+
+    tag_filter_textfield =  ft.TextField(label="Filter...", on_change=update_tag_filter, on_submit=add_typed_tag_filter)
     tags_view = ft.Column(
         alignment=ft.MainAxisAlignment.START,
         horizontal_alignment=ft.CrossAxisAlignment.START,
@@ -692,25 +1141,7 @@ def main(page: ft.Page):
                 ),
             ]),
             # TODO Move these to a collapsible section?
-            ft.Tabs(
-                selected_index=0,
-                animation_duration=100,
-                expand=True,
-                tabs=[
-                    ft.Tab(
-                        text="Tags",
-                        content=tag_controls["tags"],
-                    ),
-                    ft.Tab(
-                        text="Loras",
-                        content=tag_controls["loras"],
-                    ),
-                    ft.Tab(
-                        text="Models",
-                        content=tag_controls["models"],
-                    ),
-                ],
-            )
+            tag_browser.view,
         ])
 
     ## TODO Use page.overlay instead of your own stack, dummy
@@ -720,10 +1151,12 @@ def main(page: ft.Page):
         nonlocal image_popup
         image_popup.visible = False
         slideshow_button.stop_slideshow()
+        print(f"Viewer cache: {viewer_cache.stats()}")
         page.update()
 
     favorites_button = None
 
+    @holding_index_lock
     def toggle_favorite(image_data: PngData, e):
         image_data.favorite = not image_data.favorite
 
@@ -731,13 +1164,12 @@ def main(page: ft.Page):
 
         favorites_button.selected = image_data.favorite
 
+        image_gallery.set_favorite(image_data.image_path, image_data.favorite)
         if image_data.favorite:
-            image_gallery_favorites.add_image(image_data)
-            image_gallery_favorites.sort()
+            image_gallery_favorites.add_image(image_data, get_file_size(image_data.image_path))
+            image_gallery_favorites.update()
         else:
-            for i, entry in enumerate(image_gallery_favorites.grid.controls):
-                if entry.data.image_path == image_data.image_path:
-                    del image_gallery_favorites.grid.controls[i]
+            image_gallery_favorites.delete(image_data.image_path)
 
         image_gallery_favorites.grid.update()
         favorites_button.update()
@@ -821,6 +1253,9 @@ def main(page: ft.Page):
     load_subview(0)
 
     page.on_keyboard_event = on_keyboard
-ft.app(target=main)
-stop_threads(False)
-print("Done! Adios!")
\ No newline at end of file
+
+# Worker processes re-import this module on spawn, so only the real main process may start the app
+if __name__ == "__main__":
+    ft.app(target=main)
+    stop_threads(False)
+    print("Done! Adios!")
\ No newline at end of file
@@ -0,0 +1,44 @@
+# Usage: python -m unittest discover tests
+from collections import Counter
+import random
+import unittest
+
+from lib.tag_cache import TagCache
+
+class TagFacetsTest(unittest.TestCase):
+    def test_counts_stay_right_as_images_come_and_go(self):
+        rng = random.Random(0)
+        tag_cache = TagCache()
+        image_tags = {} # What tag_cache should have, to count by brute force
+        def add_image(i):
+            # A few common tags and a long tail, so both kinds of counting are used
+            tags = set(rng.sample(range(4), rng.randint(0, 3))) | set(rng.sample(range(4, 300), rng.randint(0, 5)))
+            image_tags[f"{i}.png"] = [f"tag {tag}" for tag in tags]
+            tag_cache.add_all(image_tags[f"{i}.png"], f"{i}.png")
+        def remove_image(image_path):
+            for tag in image_tags.pop(image_path):
+                tag_cache.remove(tag, image_path)
+            tag_cache.remove_image(image_path)
+
+        for i in range(500):
+            add_image(i)
+        facets = tag_cache.get_facets()
+        next_image = 500
+        for step in range(40):
+            for _ in range(rng.randint(0, 20)):
+                add_image(next_image)
+                next_image += 1
+            for image_path in rng.sample(sorted(image_tags), rng.randint(0, 10)):
+                remove_image(image_path)
+            image_path = rng.choice(sorted(image_tags))
+            if image_tags[image_path]:
+                tag = image_tags[image_path].pop()
+                tag_cache.remove(tag, image_path)
+
+            selection = tag_cache.get_bitmap(f"tag {step % 4}") if step % 3 else tag_cache.get_all_bitmap()
+            expected = Counter(tag for image_path in tag_cache.get_paths(selection) for tag in image_tags[image_path])
+            self.assertIs(tag_cache.get_facets(), facets)
+            self.assertEqual(facets.count(selection), dict(expected), f"Step {step}")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+# Usage: python -m unittest discover tests
+import os
+import random
+import tempfile
+import unittest
+
+from PIL import Image
+
+import lib.image_helpers as imagez
+from lib.viewer_cache import ViewerCache
+
+VIEWER_SIZE = (96, 64)
+PREFETCH_STEPS = (1, -1, 2, -2) # As the viewer asks for them
+
+class ViewerCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.image_paths = []
+        for i in range(8):
+            image_path = os.path.join(self.temp_dir.name, f"{i:05}.png")
+            Image.effect_noise((128, 128), 40 + i).convert("RGB").save(image_path)
+            self.image_paths.append(image_path)
+        self.viewer_cache = ViewerCache(lambda image_path: imagez.load_display_image(image_path, VIEWER_SIZE), 64 * 1024 * 1024)
+
+    def tearDown(self):
+        self.viewer_cache.stop()
+        self.temp_dir.cleanup()
+
+    def show(self, index):
+        # Like create_image_popup: a lookup, a load on a miss, then the neighbours are prefetched
+        image_path = self.image_paths[index]
+        if self.viewer_cache.lookup(image_path) is None:
+            self.viewer_cache.load(image_path)
+        self.viewer_cache.prefetch([self.image_paths[(index + step) % len(self.image_paths)] for step in PREFETCH_STEPS])
+
+    def test_stepping_within_prefetched_neighbours_reads_nothing(self):
+        self.show(0)
+        self.assertTrue(self.viewer_cache.wait_for_prefetch(timeout=10))
+        rng = random.Random(0)
+        index = 0
+        for _ in range(len(self.image_paths) * 4):
+            index = (index + rng.choice(PREFETCH_STEPS)) % len(self.image_paths)
+            reads = self.viewer_cache.reads
+            self.show(index)
+            self.assertEqual(self.viewer_cache.reads, reads, f"Showing {self.image_paths[index]} read it from disk")
+            self.assertTrue(self.viewer_cache.wait_for_prefetch(timeout=10))
+
+if __name__ == "__main__":
+    unittest.main()